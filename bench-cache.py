@@ -0,0 +1,88 @@
+
+"""Latency of CacheRecommender predict and recommend.
+    old: dict lookup for each item, recommend sorts predict of all items.
+    new: binary search on sorted arrays, recommend slices the ranking.
+"""
+
+import os
+import time
+import tempfile
+import logging
+
+import numpy as np
+
+import poi
+from poi.models import Recommender
+from poi.cache import dump_binary, load
+from utils import setup_log
+
+log = logging.getLogger("bench-cache")
+
+
+class Random(Recommender):
+    def __init__(self, num_users, num_items, seed=0):
+        super(Random, self).__init__()
+        self.num_users = num_users
+        self.num_items = num_items
+        self.rng = np.random.RandomState(seed)
+        self.checkins = poi.CheckinMatrix.from_dict({}, num_users, num_items)
+
+    def score_batch(self, users):
+        return self.rng.rand(len(users), self.num_items)
+
+
+def old_predict(data, user, item):
+    if user in data and item in data[user]:
+        return data[user][item]
+    return -10 * 10
+
+
+def old_recommend(data, num_items, user, num):
+    scores = [(poi, old_predict(data, user, poi)) for poi in xrange(num_items)]
+    scores.sort(key=lambda x: x[1], reverse=True)
+    return [poi for poi, s in scores[: num]]
+
+
+def timeit(func, users):
+    t0 = time.time()
+    for user in users:
+        func(user)
+    return (time.time() - t0) / len(users) * 1e6
+
+
+def bench(model, filename, num):
+    num_users, num_items = model.num_users, model.num_items
+    dump_binary(model, filename, num=num)
+    cr = load(filename)
+    data = {}
+    for user in xrange(num_users):
+        data[user] = dict(zip(cr._items[user].tolist(),
+                              cr._scores[user].tolist()))
+
+    users = np.random.randint(0, num_users, 200).tolist()
+    queries = np.random.randint(0, num_items, 100)
+    results = [
+        ("predict 100 items",
+         lambda u: [old_predict(data, u, i) for i in queries],
+         lambda u: cr.predict_many(u, queries)),
+        ("recommend 10",
+         lambda u: old_recommend(data, num_items, u, 10),
+         lambda u: cr.recommend(u, 10)),
+    ]
+    for name, old, new in results:
+        t_old = timeit(old, users)
+        t_new = timeit(new, users)
+        log.info("%-18s old %10.1fus  new %8.1fus  x%.0f" %
+                 (name, t_old, t_new, t_old / t_new))
+
+
+if __name__ == "__main__":
+    setup_log("./log/bench-cache.log")
+    num_users, num_items, num = 2000, 10000, 1000
+    model = Random(num_users, num_items)
+    fd, filename = tempfile.mkstemp(suffix=".bin")
+    os.close(fd)
+    try:
+        bench(model, filename, num)
+    finally:
+        os.remove(filename)
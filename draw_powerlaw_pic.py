@@ -6,8 +6,8 @@ from utils import *
 if __name__ == "__main__":
     setup_log()
     fn = Filename("foursquare")
-    locations = poi.load_locations(open(fn.locations)) 
-    cks = poi.load_checkins(open(fn.train))
+    locations = poi.bulk_load_locations(fn.locations) 
+    cks = poi.bulk_load_checkins(fn.train)
 
     pl = poi.PowerLaw(cks, locations)
     pl.count()
@@ -13,6 +13,8 @@ __author__ = 'jchluo'
 
 # load data
 from .loader import load_checkins, load_locations 
+from .loader import bulk_load_checkins, bulk_load_locations
+from .checkins import CheckinMatrix
 # models
 from .wmf import WMF
 from .bpr import BPR
@@ -22,7 +24,7 @@ from .powerlaw import PowerLaw
 from .pd import PD
 #eval
 from .models import Evaluation, assess
-from .cache import dump, load
+from .cache import dump, dump_binary, dump_segment, dump_shards, load
 
 import logging
 try:  # Python 2.7+
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""Implicit Alternating Least Squares solver.
+    For each row u of the confidence matrix R, solve
+        (YTY + YT Cu Y + reg * I) xu = YT (Cu + I) pu
+    where Cu = diag(ru) and pu = (ru != 0), see WMF paper:
+    Collaborative Filtering for Implicit Feedback Datasets.
+    Only nonzero entries of each row are touched, and YTY
+    is computed once for a sweep.
+    solver:
+        cholesky: exact solve row by row.
+        cg: a few conjugate gradient steps start from the current
+            vectors, all rows step together.
+    Rows are independent, `ParallelALS` splits them over processes.
+"""
+
+import logging
+
+import numpy as np
+try:
+    import scipy.sparse as sparse
+    from scipy.linalg import cho_factor, cho_solve
+except:
+    pass
+
+from .utils import shared_array
+from .executor import Executor, get_state
+
+__all__ = ["least_squares", "ParallelALS"]
+
+log = logging.getLogger(__name__)
+
+SOLVERS = ("cholesky", "cg")
+
+
+def _slice_rows(matrix, start, end):
+    """Return indptr, indices, data of rows [start, end) of csr matrix.
+    """
+    lo = matrix.indptr[start]
+    hi = matrix.indptr[end]
+    indptr = matrix.indptr[start: end + 1] - lo
+    indices = matrix.indices[lo: hi]
+    data = np.asarray(matrix.data[lo: hi], dtype=float)
+    return indptr, indices, data
+
+
+def _solve_cholesky(matrix, fixed, A0, start, end, out):
+    indptr, indices, data = _slice_rows(matrix, start, end)
+    for r in xrange(end - start):
+        lo, hi = indptr[r], indptr[r + 1]
+        if lo == hi:
+            out[start + r] = 0.0
+            continue
+        conf = data[lo: hi]
+        Y = fixed[indices[lo: hi]]
+        A = A0 + (Y.T * conf).dot(Y)
+        b = Y.T.dot(conf + 1.0)
+        out[start + r] = cho_solve(cho_factor(A), b)
+
+
+def _solve_cg(matrix, fixed, A0, start, end, out, init, steps):
+    indptr, indices, data = _slice_rows(matrix, start, end)
+    shape = (end - start, fixed.shape[0])
+    rows = np.repeat(np.arange(end - start), np.diff(indptr))
+    Y = fixed[indices]
+
+    def dot(P):
+        # (YTY + YT Cu Y + reg * I) p for every row at once
+        conf = data * np.einsum("ij,ij->i", Y, P[rows])
+        C = sparse.csr_matrix((conf, indices, indptr), shape=shape)
+        return P.dot(A0) + C.dot(fixed)
+
+    C = sparse.csr_matrix((data + 1.0, indices, indptr), shape=shape)
+    x = np.array(init[start: end], dtype=float)
+    res = C.dot(fixed) - dot(x)
+    p = res.copy()
+    rsold = (res * res).sum(axis=1)
+    for i in xrange(steps):
+        active = rsold > 1e-20
+        if not active.any():
+            break
+        Ap = dot(p)
+        pAp = (p * Ap).sum(axis=1)
+        alpha = np.where(active, rsold / np.where(active, pAp, 1.0), 0.0)
+        x += alpha[:, None] * p
+        res -= alpha[:, None] * Ap
+        rsnew = (res * res).sum(axis=1)
+        beta = np.where(active, rsnew / np.where(active, rsold, 1.0), 0.0)
+        p = res + beta[:, None] * p
+        rsold = rsnew
+    out[start: end] = x
+
+
+def least_squares(matrix, fixed, reg_param, solver="cholesky", init=None,
+                  cg_steps=3, start=0, end=None, out=None):
+    """Solve the vectors of rows [start, end) of matrix.
+    matrix  : confidence csr matrix, (num_solve, num_fixed).
+    fixed   : fixed vectors, numpy array (num_fixed, num_factors).
+    reg_param: regularization parameter.
+    solver  : "cholesky" or "cg".
+    init    : current vectors (num_solve, num_factors), start point of cg.
+    cg_steps: conjugate gradient steps of each row.
+    out     : write solutions to out[start: end] if assigned.
+    return  : out, or a new array of all rows.
+    usage:
+     >>> from scipy.sparse import csr_matrix
+     >>> m = csr_matrix([[2.0, 0.0], [0.0, 1.0]])
+     >>> y = np.array([[1.0], [0.5]])
+     >>> x = least_squares(m, y, 0.1)
+     >>> z = least_squares(m, y, 0.1, solver="cg", init=np.zeros((2, 1)))
+     >>> print np.allclose(x, z)
+     True
+    """
+    if solver not in SOLVERS:
+        raise ValueError("solver should be one of %s." % (SOLVERS, ))
+    num_solve = matrix.shape[0]
+    num_factors = fixed.shape[1]
+    if end is None:
+        end = num_solve
+    if out is None:
+        out = np.zeros((num_solve, num_factors))
+
+    fixed = np.asarray(fixed, dtype=float)
+    A0 = fixed.T.dot(fixed) + reg_param * np.eye(num_factors)
+    if solver == "cholesky":
+        _solve_cholesky(matrix, fixed, A0, start, end, out)
+    else:
+        if init is None:
+            init = out
+        _solve_cg(matrix, fixed, A0, start, end, out, init, cg_steps)
+    return out
+
+
+def _share_csr(matrix):
+    data = shared_array(matrix.data.shape, float, matrix.data)
+    indices = shared_array(matrix.indices.shape, matrix.indices.dtype, 
+                           matrix.indices)
+    indptr = shared_array(matrix.indptr.shape, matrix.indptr.dtype,
+                          matrix.indptr)
+    return sparse.csr_matrix((data, indices, indptr), 
+                             shape=matrix.shape, copy=False)
+
+
+def _proxy_solve(args):
+    user, start, end = args
+    state = get_state()
+    if user:
+        matrix = state["users"]
+        fixed = state["item_vectors"]
+        out = state["user_vectors"]
+    else:
+        matrix = state["items"]
+        fixed = state["user_vectors"]
+        out = state["item_vectors"]
+    least_squares(matrix, fixed, state["reg_param"], 
+                  solver=state["solver"], init=out, 
+                  cg_steps=state["cg_steps"], 
+                  start=start, end=end, out=out)
+    return end - start
+
+
+class ParallelALS(object):
+    """Solve half sweeps on a process pool.
+    Confidence matrix and both factor matrices are copied to shared memory 
+    and shipped to workers as the executor state, tasks only carry a row 
+    range, workers write solutions in place.
+    usage:
+     >>> from scipy.sparse import csr_matrix
+     >>> m = csr_matrix([[2.0, 0.0], [0.0, 1.0]])
+     >>> als = ParallelALS(m, np.ones((2, 1)), np.ones((2, 1)), 0.1, n_jobs=2)
+     >>> als.solve(True)
+     >>> x = least_squares(m, np.ones((2, 1)), 0.1)
+     >>> print np.allclose(als.user_vectors, x)
+     True
+     >>> als.close()
+    """
+    def __init__(self, matrix, user_vectors, item_vectors, reg_param, 
+                 solver="cholesky", cg_steps=3, n_jobs=4):
+        self.n_jobs = n_jobs
+        self.user_vectors = shared_array(user_vectors.shape, float, 
+                                         user_vectors)
+        self.item_vectors = shared_array(item_vectors.shape, float, 
+                                         item_vectors)
+        state = {
+            "users": _share_csr(matrix),
+            "items": _share_csr(matrix.T.tocsr()),
+            "user_vectors": self.user_vectors,
+            "item_vectors": self.item_vectors,
+            "reg_param": reg_param,
+            "solver": solver,
+            "cg_steps": cg_steps,
+        }
+        self.executor = Executor(n_jobs, state=state)
+
+    def solve(self, user):
+        """Solve user vectors if user is True, else item vectors, in place.
+        """
+        if user:
+            num_solve = self.user_vectors.shape[0]
+        else:
+            num_solve = self.item_vectors.shape[0]
+        # some more tasks than workers, to balance rows of different length
+        num_tasks = max(min(self.n_jobs * 4, num_solve), 1)
+        bounds = np.linspace(0, num_solve, num_tasks + 1).astype(int)
+        args = [(user, bounds[i], bounds[i + 1]) for i in xrange(num_tasks)]
+        self.executor.map(_proxy_solve, args)
+
+    def close(self):
+        self.executor.close()
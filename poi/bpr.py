@@ -4,20 +4,58 @@ import time
 import logging
 import math
 
+from multiprocessing import Value
+
 import numpy as np
 from .models import Recommender 
-from .utils import randint, threads
+from .utils import shared_array
+from .sampling import make_sampler
+from .executor import Executor, get_state
 
 __all__ = ["BPR"]
 
 log = logging.getLogger(__name__)
 
-def _proxy_samples(args):
-    model, size = args
-    return model.create_samples(size)
+def _proxy_hogwild(args):
+    """Run num_batchs batches in a worker, update shared vectors 
+    without lock.
+    """
+    worker, num_batchs, seed = args
+    state = get_state()
+    model = state["model"]
+    step = state["step"]
+    learn_rate = state["learn_rate"]
+    model.sampler.seed(seed)
+    t0 = time.time()
+    for b in xrange(num_batchs):
+        # learn rate decays with batches done by all workers
+        with step.get_lock():
+            step.value += 1
+            n = step.value
+        model.learn_rate = learn_rate * model.decay_rate ** n
+        samples = model.create_samples(model.size_batch)
+        if model.update == "batch":
+            model.update_batch(samples)
+        else:
+            model.update_sgd(samples)
+    t1 = time.time()
+    return (worker, num_batchs * model.size_batch, t1 - t0)
 
 
 class BPR(Recommender):
+    """Bayesian Personalized Ranking, trained by SGD.
+    update: "sgd" update vectors triple by triple, in sample order.
+            "batch" update a whole sample batch at once with numpy,
+            gradients of repeated users/items are accumulated.
+    sampler: negative sampling strategy, "uniform", "popularity", "geo" 
+            or "dynamic", see `poi.sampling`.
+    locations: poi locations, used by "geo" sampler.
+    sampler_args: dict, other arguments of the sampler.
+    seed  : seed of the negative sampler.
+    n_jobs: number of hogwild worker processes, 1 train in this process.
+            Workers sample and update vectors in shared memory without 
+            lock, learn rate decays with batches done by all workers.
+    """
     def __init__(self, 
                  checkins, 
                  num_factors=10, 
@@ -27,7 +65,13 @@ class BPR(Recommender):
                  reg_user=0.02,
                  reg_item=0.02,
                  reg_bias=0.02,
-                 size_batch=None):
+                 size_batch=None,
+                 update="sgd",
+                 sampler="uniform",
+                 locations=None,
+                 sampler_args=None,
+                 seed=None,
+                 n_jobs=1):
         super(BPR, self).__init__(checkins);
         self.num_factors = num_factors
         self.num_iters = num_iters
@@ -37,11 +81,19 @@ class BPR(Recommender):
         self.reg_item = reg_item
         self.reg_bias = reg_bias
         self.current = 0 
+        if update not in ("sgd", "batch"):
+            raise ValueError("update should be sgd or batch.")
+        self.update = update
+        self.seed = seed
+        self.n_jobs = n_jobs
         self.num_batchs = 500 # decay learn rate how many times in a iteration
         if size_batch is None:
             self.size_batch = int(math.sqrt(self.num_users) * 100);
         else:
             self.size_batch = size_batch 
+        self.sampler = make_sampler(sampler, self.checkins.csr, seed=seed, model=self,
+                                    locations=locations, 
+                                    **(sampler_args or {}))
             
         # INIT should be small float
         self.user_vectors = 0.1 * np.random.normal(
@@ -54,28 +106,24 @@ class BPR(Recommender):
             (self.num_factors, self.learn_rate, self.reg_user, self.reg_item)
 
     def create_samples(self, size):
-        samples = []
-        for i in xrange(size):
-            locs = set()
-            while len(locs) == 0:
-                rand_user = randint(self.num_users)
-                locs = self.checkins[rand_user].keys()
-
-            rand_item = randint(self.num_items)
-            if rand_item in locs:
-                neg_item = randint(self.num_items)
-                while neg_item in locs:
-                    neg_item = randint(self.num_items)
-                wrap = (rand_user, rand_item, neg_item) 
-                samples.append(wrap)
-            else:
-                locs = list(locs)
-                pos_item = locs[randint(len(locs))]
-                wrap = (rand_user, pos_item, rand_item) 
-                samples.append(wrap)
-        return samples
+        """Draw size (user, pos, neg) triples. 
+        return: (size, 3) int array.
+        """
+        return np.column_stack(self.sampler.sample(size))
 
     def train(self, before=None, after=None):
+        executor = None
+        if self.n_jobs > 1:
+            executor = self._hogwild_executor()
+        try:
+            self._train(executor, before, after)
+        finally:
+            if executor is not None:
+                executor.close()
+                self.user_vectors = np.array(self.user_vectors)
+                self.item_vectors = np.array(self.item_vectors)
+
+    def _train(self, executor, before, after):
         while self.current < self.num_iters:
             t0 = time.time()
             self.current += 1 
@@ -83,39 +131,119 @@ class BPR(Recommender):
             if before is not None:
                 before(self)
 
-            t3 = time.time()
-            # samples
-            args = [(self, self.size_batch) for i in xrange(self.num_batchs)]
-            samples = threads(_proxy_samples, args)
+            if executor is not None:
+                self._hogwild_iteration(executor)
+            else:
+                self._iteration()
 
-            t4 = time.time()
-            log.debug("sample %i, time %.2f" % (self.num_batchs * self.size_batch, (t4 - t3)))
-
-            # update a batch
-            for b in xrange(self.num_batchs):
-                # update learn rate
-                self.learn_rate *= self.decay_rate
-                for user, pos, neg in samples[b]: 
-                    x = self.predict(user, pos) - self.predict(user, neg)
-                    z = 1.0 / (1.0 + math.exp(x))
-                    uvec = self.user_vectors[user]
-                    ipvec = self.item_vectors[pos]
-                    invec = self.item_vectors[neg]
-
-                    self.user_vectors[user] += \
-                        self.learn_rate * ((ipvec - invec) * z - self.reg_user * uvec)
-                    self.item_vectors[pos] += \
-                        self.learn_rate * (uvec * z - self.reg_item * ipvec)
-                    self.item_vectors[neg] += \
-                            self.learn_rate * (-uvec * z - self.reg_item * invec)
-                
-            t5 = time.time()
-            log.debug('update, time %.2f' % (t5 - t4))
             if after is not None:
                 after(self)
             t1 = time.time()
             log.debug('Iteration %i finished, time %.2f' % (self.current, t1 - t0))
 
+    def _iteration(self):
+        t3 = time.time()
+        seconds = 0.0
+        # update a batch, samples are drawn per batch, so model aware
+        # samplers see the vectors of the latest update
+        for b in xrange(self.num_batchs):
+            t4 = time.time()
+            samples = self.create_samples(self.size_batch)
+            seconds += time.time() - t4
+            # update learn rate
+            self.learn_rate *= self.decay_rate
+            if self.update == "batch":
+                self.update_batch(samples)
+            else:
+                self.update_sgd(samples)
+            
+        t5 = time.time()
+        log.debug("sample %i, time %.2f" % 
+                  (self.num_batchs * self.size_batch, seconds))
+        log.debug('update, time %.2f' % (t5 - t3 - seconds))
+
+    def _hogwild_executor(self):
+        """Move vectors to shared memory, then fork workers.
+        """
+        self.user_vectors = shared_array(self.user_vectors.shape, float,
+                                         self.user_vectors)
+        self.item_vectors = shared_array(self.item_vectors.shape, float,
+                                         self.item_vectors)
+        state = {
+            "model": self,
+            "step": Value("l", 0),
+            "learn_rate": self.learn_rate,
+        }
+        return Executor(self.n_jobs, state=state)
+
+    def _hogwild_iteration(self, executor):
+        t0 = time.time()
+        args = []
+        for worker in xrange(self.n_jobs):
+            num = self.num_batchs // self.n_jobs
+            if worker < self.num_batchs % self.n_jobs:
+                num += 1
+            seed = None
+            if self.seed is not None:
+                seed = self.seed + self.current * self.n_jobs + worker
+            args.append((worker, num, seed))
+        stats = executor.map(_proxy_hogwild, args)
+        state = executor.state
+        self.learn_rate = state["learn_rate"] * \
+            self.decay_rate ** state["step"].value
+        t1 = time.time()
+
+        total = 0
+        for worker, num, seconds in stats:
+            total += num
+            log.debug("worker %i: %i samples, %.0f samples/s" % 
+                      (worker, num, num / max(seconds, 1e-6)))
+        log.debug("hogwild %i samples, %.0f samples/s, time %.2f" % 
+                  (total, total / max(t1 - t0, 1e-6), t1 - t0))
+
+    def update_sgd(self, samples):
+        """Update vectors triple by triple.
+        """
+        for user, pos, neg in np.asarray(samples).tolist(): 
+            x = self.predict(user, pos) - self.predict(user, neg)
+            z = 1.0 / (1.0 + math.exp(x))
+            uvec = self.user_vectors[user]
+            ipvec = self.item_vectors[pos]
+            invec = self.item_vectors[neg]
+
+            self.user_vectors[user] += \
+                self.learn_rate * ((ipvec - invec) * z - self.reg_user * uvec)
+            self.item_vectors[pos] += \
+                self.learn_rate * (uvec * z - self.reg_item * ipvec)
+            self.item_vectors[neg] += \
+                    self.learn_rate * (-uvec * z - self.reg_item * invec)
+
+    def update_batch(self, samples):
+        """Update vectors by all (user, pos, neg) triples in samples at once,
+        all gradients are computed from the vectors before update.
+        """
+        samples = np.asarray(samples, dtype=int).reshape(-1, 3)
+        users, pos, neg = samples.T
+        uvec = self.user_vectors[users]
+        ipvec = self.item_vectors[pos]
+        invec = self.item_vectors[neg]
+
+        x = (uvec * (ipvec - invec)).sum(axis=1)
+        z = 1.0 / (1.0 + np.exp(np.clip(x, -50.0, 50.0)))
+        z = z[:, None]
+        np.add.at(self.user_vectors, users, 
+                  self.learn_rate * ((ipvec - invec) * z - self.reg_user * uvec))
+        np.add.at(self.item_vectors, pos,
+                  self.learn_rate * (uvec * z - self.reg_item * ipvec))
+        np.add.at(self.item_vectors, neg,
+                  self.learn_rate * (-uvec * z - self.reg_item * invec))
+
     def predict(self, user, item):
         return self.user_vectors[user].T.dot(self.item_vectors[item])
 
+    def score_all(self, user):
+        return self.item_vectors.dot(self.user_vectors[user])
+
+    def score_batch(self, users):
+        return self.user_vectors[np.asarray(users)].dot(self.item_vectors.T)
+
@@ -3,9 +3,17 @@
 """Cache Recommender.
     dump : run topN predict item for each user, and 
         dump them to file like object(disk file or memory).
+    dump_binary: same as dump, but write a binary file, which is 
+        memory mapped by load, see `dump_binary` for the format.
+    dump_segment: refresh part of users into a new segment of a cache 
+        directory, a manifest records the segment owns each user.
+    dump_shards: rank all users shard by shard on workers, each shard
+        streamed to a segment of a cache directory.
     load : recover from file like object, return CacheRecommender.
         Note that this recommender just a tiny version of the original one,
-        which can only predict topN (stored in file) items.
+        which can only predict topN (stored in file) items, 
+        `predict_many` scores many items of a user at once. 
+        Segments of a directory are opened lazily.
     usage:
     >>> class M(object):
     ...    def __init__(self):
@@ -31,26 +39,41 @@
     Test
 """
 
+import os
 import time
 import json
+import struct
 import logging
 
 import numpy as np
-from .utils import threads
-from .models import Recommender
+from .models import Recommender, batchable
+from .executor import Executor, get_state
+from .checkins import CheckinMatrix
 
 
 log = logging.getLogger(__name__)
 
-__all__ = ["Recommender", "Evaluation"]
+__all__ = ["CacheRecommender", "SegmentRecommender", "dump", "dump_binary",
+           "dump_segment", "dump_shards", "changed_users", "load"]
+
+MAGIC = b"POICACHE"
+VERSION = 1
+# arrays start at multiple of ALIGN bytes
+ALIGN = 64
 
 class CacheRecommender(Recommender):
     """Cache File Recommender.
+    Items and scores are kept as (num_users, num) arrays, ranked, 
+    memory mapped for binary cache. Each row also has its items sorted,
+    for binary search in `predict_many`.
     """
     def __init__(self):
         self.checkins = {}
-        self._data = {}
         self._meta = {}
+        self._items = None
+        self._scores = None
+        self._sorted = None
+        self._order = None
 
     def __getattr__(self, attr):
         if attr == "_meta":
@@ -62,37 +85,117 @@ class CacheRecommender(Recommender):
     def __repr__(self):
         return "<Cache %s>" % self._meta["__repr__"][1: -1]
 
+    def _set_arrays(self, items, scores, sorted_items=None, order=None):
+        self._items = items
+        self._scores = scores
+        if order is None:
+            order = np.argsort(items, axis=1, kind="mergesort")
+            order = order.astype(np.int32)
+            rows = np.arange(len(items))[:, None]
+            sorted_items = items[rows, order]
+        self._sorted = sorted_items
+        self._order = order
+
+    def _row(self, user):
+        """(items, scores, sorted, order) of user, None if not cached.
+        """
+        if not 0 <= user < len(self._items):
+            return None
+        return (self._items[user], self._scores[user], 
+                self._sorted[user], self._order[user])
+
+    def predict_many(self, user, items):
+        """Scores of items, -100 for items not cached.
+        """
+        items = np.asarray(items)
+        scores = np.zeros(len(items)) - 10 * 10
+        row = self._row(user)
+        if row is None or len(row[0]) == 0:
+            return scores
+        ranked, ranked_scores, sorted_items, order = row
+        pos = np.searchsorted(sorted_items, items)
+        pos[pos >= len(sorted_items)] = len(sorted_items) - 1
+        found = sorted_items[pos] == items
+        scores[found] = ranked_scores[order[pos[found]]]
+        return scores
+
     def predict(self, user, item):
-        return self._data.get(user, {}).get(item, -10 * 10)
+        return float(self.predict_many(user, [item])[0])
 
+    def recommend(self, user, num=5, ruleout=True):
+        """Cached items are ranked and have no checkins, just slice them.
+        """
+        row = self._row(user)
+        if row is None:
+            return []
+        items = row[0][: num]
+        return items[items >= 0].tolist()
+
+
+class SegmentRecommender(CacheRecommender):
+    """Cache of a directory, see `dump_segment` and `dump_shards`. 
+    A segment is memory mapped when a user it owns is first asked for,
+    segments of the loaded manifest are kept until the second commit 
+    after it, see `_commit`, reload the directory to see new dumps.
+    """
+    def __init__(self, directory, manifest, owner):
+        super(SegmentRecommender, self).__init__()
+        self.directory = directory
+        self._meta = manifest["meta"]
+        self._owner = owner
+        self._segments = {}
 
-def _proxy_predict(arg):
-    model, i, num = arg
+    def _open(self, sid):
+        if sid not in self._segments:
+            path = os.path.join(self.directory, _segment(sid))
+            self._segments[sid] = _open_binary(path)[1]
+        return self._segments[sid]
+
+    def _row(self, user):
+        if not 0 <= user < len(self._owner) or self._owner[user] < 0:
+            return None
+        seg = self._open(int(self._owner[user]))
+        r = np.searchsorted(seg["users"], user)
+        return (seg["items"][r], seg["scores"][r], 
+                seg["sorted"][r], seg["order"][r])
+
+
+def _proxy_predict(i):
+    model, num = get_state()
     scores = [(j, model.predict(i, j)) for j in xrange(model.num_items)\
             if j not in model.checkins[i]]
     scores.sort(key=lambda x: x[1], reverse=True)
     return [i, scores[: num]]
 
 
-def dump(model, fp, num=1000, attrs=None, num_pool=4):
-    """Dump predict record to file.
-        fp: file pointer like object, 
-        num: top num item and its score will be stored,
-            other item will be abandoned.
-        attrs: list like, the attributes want to be stored,
-                num_items and num_users will auto stored.
-        num_pool: number of threads, 0 will turn off multiple threads.
+def _rank(model, num, num_pool=4, block_size=None, users=None):
+    """Top num items and scores of users, all users if None.
+    return: (items, scores), (len(users), num) arrays, item -1 if empty.
     """
-    if model is None:
-        raise ValueError("model is None.") 
+    if users is None:
+        users = np.arange(model.num_users)
+    users = np.asarray(users, dtype=int)
+    if batchable(model):
+        return model.rank_batch(users, num, block_size=block_size)
+
+    # model is shipped to workers once, tasks are user ids. One pool
+    # serves the whole dump, a dump is a single pass, and workers must
+    # see the model as it is now, a pool kept from an earlier dump would
+    # still hold the model of its fork time.
+    chunksize = max(1, len(users) // (max(num_pool, 1) * 8))
+    rows = dict((user, r) for r, user in enumerate(users.tolist()))
+    items = np.zeros((len(users), num), dtype=np.int32) - 1
+    scores = np.zeros((len(users), num)) - np.inf
+    with Executor(num_pool, state=(model, num)) as executor:
+        for i, pairs in executor.imap(_proxy_predict, 
+                                      users.tolist(), chunksize):
+            for r, (j, score) in enumerate(pairs):
+                items[rows[i], r] = j
+                scores[rows[i], r] = score
+    return items, scores
 
-    t0 = time.time()
-    args = [(model, i, num) for i in xrange(model.num_users)]
-    if num_pool > 0:
-        results = threads(_proxy_predict, args, num_pool)
-    else:
-        results = [_proxy_predict(arg) for arg in args]
 
+def _meta(model, attrs):
     meta = {}
     # write attributes
     if attrs is None:
@@ -107,30 +210,365 @@ def dump(model, fp, num=1000, attrs=None, num_pool=4):
         meta[attr] = getattr(model, attr)
     # write __repr__
     meta["__repr__"] = str(model)
-    print >> fp, json.dumps(meta)
+    return meta
+
+
+def dump(model, fp, num=1000, attrs=None, num_pool=4, block_size=None):
+    """Dump predict record to file.
+        fp: file pointer like object, 
+        num: top num item and its score will be stored,
+            other item will be abandoned.
+        attrs: list like, the attributes want to be stored,
+                num_items and num_users will auto stored.
+        num_pool: number of threads, 0 will turn off multiple threads.
+        block_size: users scored together when the model supports
+                `rank_batch`, see `Recommender`, num_pool is unused then.
+    """
+    if model is None:
+        raise ValueError("model is None.") 
+
+    t0 = time.time()
+    items, scores = _rank(model, num, num_pool, block_size)
+    print >> fp, json.dumps(_meta(model, attrs))
     # write recoreds
-    for one in results: 
-        print >> fp, json.dumps(one)
+    for i in xrange(len(items)):
+        valid = items[i] >= 0
+        pairs = zip(items[i][valid].tolist(), scores[i][valid].tolist())
+        print >> fp, json.dumps([i, list(pairs)])
 
     t1 = time.time()
     log.debug("dump ok, time: %.2fs" % (t1 - t0))
 
 
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _write_binary(fp, meta, arrays):
+    """Write header and arrays, arrays: [(name, array), ...].
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"version": VERSION, "meta": meta, 
+                         "arrays": layout}).encode("utf-8")
+    start = _align(len(MAGIC) + 4 + len(header))
+    fp.write(MAGIC)
+    fp.write(struct.pack("<I", len(header)))
+    fp.write(header)
+    position = len(MAGIC) + 4 + len(header)
+    for name, array in arrays:
+        target = start + layout[name][0]
+        fp.write(b"\0" * (target - position))
+        fp.write(array.tobytes())
+        position = target + array.nbytes
+
+
+def _arrays(items, scores):
+    order = np.argsort(items, axis=1, kind="mergesort")
+    rows = np.arange(len(items))[:, None]
+    return [("items", items.astype("<i4")), 
+            ("scores", scores.astype("<f4")),
+            ("sorted", items[rows, order].astype("<i4")),
+            ("order", order.astype("<i4"))]
+
+
+def dump_binary(model, filename, num=1000, attrs=None, num_pool=4, 
+                block_size=None):
+    """Dump predict record to a binary file, arguments see `dump`.
+    format:
+        MAGIC, header length (uint32 little endian), JSON header 
+        {"version", "meta", "arrays": {name: [offset, dtype, shape]}},
+        then arrays, each starts at a multiple of ALIGN bytes, 
+        offset counts from the first array:
+            items : int32 (num_users, num), -1 if empty.
+            scores: float32 (num_users, num).
+            sorted: int32 (num_users, num), items of each row sorted.
+            order : int32 (num_users, num), sorted = items[order] of row.
+    """
+    if model is None:
+        raise ValueError("model is None.") 
+
+    t0 = time.time()
+    items, scores = _rank(model, num, num_pool, block_size)
+    arrays = _arrays(items, scores)
+    with open(filename, "wb") as fp:
+        _write_binary(fp, _meta(model, attrs), arrays)
+    t1 = time.time()
+    log.debug("dump binary ok, time: %.2fs" % (t1 - t0))
+
+
+def _open_binary(filename):
+    """Memory map arrays of a binary cache file.
+    return: (header, {name: array})
+    """
+    with open(filename, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary cache." % filename)
+        size = struct.unpack("<I", fp.read(4))[0]
+        header = json.loads(fp.read(size).decode("utf-8"))
+    if header["version"] > VERSION:
+        raise ValueError("unknown cache version: %s." % header["version"])
+    start = _align(len(MAGIC) + 4 + size)
+    arrays = {}
+    for name, (offset, dtype, shape) in header["arrays"].items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[name] = np.memmap(filename, dtype=dtype, mode="r",
+                                 offset=start + offset, shape=tuple(shape))
+    return header, arrays
+
+
+def _load_binary(filename):
+    header, arrays = _open_binary(filename)
+    cr = CacheRecommender()
+    cr._meta = header["meta"]
+    # files without sorted arrays get them computed in memory
+    cr._set_arrays(arrays["items"], arrays["scores"], 
+                   arrays.get("sorted"), arrays.get("order"))
+    return cr
+
+
+MANIFEST = "manifest.json"
+
+
+def _read_manifest(directory):
+    """return: (manifest, owner, fingerprints), None if not exists.
+    owner: int32 array, segment id owns each user, -1 if none.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        manifest = json.load(fp)
+    if manifest["version"] > VERSION:
+        raise ValueError("unknown manifest version: %s." % manifest["version"])
+    state = np.load(os.path.join(directory, manifest["state"]))
+    return manifest, state["owner"], state["fingerprints"]
+
+
+def _segment(sid):
+    return "segment-%06i.bin" % sid
+
+
+def _checkins(model):
+    return CheckinMatrix.from_dict(model.checkins, 
+                                   model.num_users, model.num_items)
+
+
+def changed_users(model, directory):
+    """Users not in the cache of directory, or checkins changed since 
+    their segment was dumped, all users if there is no cache.
+    """
+    current = _checkins(model).fingerprints()
+    found = _read_manifest(directory)
+    if found is None:
+        return np.arange(model.num_users)
+    manifest, owner, fingerprints = found
+    n = min(len(owner), len(current))
+    changed = np.ones(len(current), dtype=bool)
+    changed[: n] = (owner[: n] < 0) | (fingerprints[: n] != current[: n])
+    return np.flatnonzero(changed)
+
+
+def _prepare(model, directory):
+    """Manifest, owner and fingerprints of directory, resized to users
+    of model, empty ones if there is no cache.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    owner = np.zeros(model.num_users, dtype=np.int32) - 1
+    fingerprints = np.zeros(model.num_users, dtype=np.uint64)
+    found = _read_manifest(directory)
+    if found is None:
+        return {"version": VERSION, "next": 0, "segments": []}, \
+            owner, fingerprints
+    manifest, old_owner, old_fingerprints = found
+    n = min(len(owner), len(old_owner))
+    owner[: n] = old_owner[: n]
+    fingerprints[: n] = old_fingerprints[: n]
+    return manifest, owner, fingerprints
+
+
+def _write_segment(directory, sid, users, items, scores, meta):
+    arrays = [("users", users.astype("<i4"))] + _arrays(items, scores)
+    with open(os.path.join(directory, _segment(sid)), "wb") as fp:
+        _write_binary(fp, meta, arrays)
+
+
+def _commit(directory, manifest, owner, fingerprints, meta, next_sid):
+    """Write new state and manifest, then remove segments owning no user
+    since the previous commit. Segments and state dropped by this commit
+    are only retired, a reader of the previous manifest opens segments
+    lazily and still finds them.
+    return: number of alive segments.
+    """
+    alive = set(np.unique(owner[owner >= 0]).tolist())
+    dead = [s for s in manifest.get("retired", []) if s not in alive]
+    old_state = manifest.get("retired_state")
+    manifest["retired"] = [s for s in manifest["segments"] 
+                           if s not in alive]
+    manifest["retired_state"] = manifest.get("state")
+    manifest["state"] = "state-%06i.npz" % (next_sid - 1)
+    manifest["segments"] = sorted(alive)
+    manifest["next"] = next_sid
+    manifest["meta"] = meta
+    np.savez(os.path.join(directory, manifest["state"]), 
+             owner=owner, fingerprints=fingerprints)
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(manifest, fp)
+    os.rename(path + ".tmp", path)
+    for s in dead:
+        path = os.path.join(directory, _segment(s))
+        if os.path.exists(path):
+            os.remove(path)
+    if old_state is not None and old_state not in \
+            (manifest["state"], manifest["retired_state"]):
+        path = os.path.join(directory, old_state)
+        if os.path.exists(path):
+            os.remove(path)
+    return len(alive)
+
+
+def dump_segment(model, directory, users=None, num=1000, attrs=None, 
+                 num_pool=4, block_size=None):
+    """Rank users into a new segment of the cache directory, the new 
+    segment owns them, others keep their old segments.
+    users: users to refresh, a shard for example, default are the 
+           `changed_users`.
+    other arguments see `dump`.
+    return: refreshed users.
+    """
+    if model is None:
+        raise ValueError("model is None.") 
+
+    t0 = time.time()
+    if users is None:
+        users = changed_users(model, directory)
+    users = np.unique(np.asarray(users, dtype=int))
+    manifest, owner, fingerprints = _prepare(model, directory)
+    if len(users) == 0:
+        log.debug("dump segment, no user to refresh.")
+        return users
+
+    sid = manifest["next"]
+    meta = _meta(model, attrs)
+    items, scores = _rank(model, num, num_pool, block_size, users)
+    _write_segment(directory, sid, users, items, scores, meta)
+
+    owner[users] = sid
+    fingerprints[users] = _checkins(model).fingerprints()[users]
+    alive = _commit(directory, manifest, owner, fingerprints, meta, sid + 1)
+    t1 = time.time()
+    log.debug("dump segment %i, %i users, %i segments, time: %.2fs" % 
+              (sid, len(users), alive, t1 - t0))
+    return users
+
+
+def _proxy_shard(args):
+    sid, users = args
+    model, num, block_size, directory, meta = get_state()
+    items, scores = _rank(model, num, 0, block_size, users)
+    _write_segment(directory, sid, users, items, scores, meta)
+    return sid, len(users)
+
+
+def dump_shards(model, directory, users=None, num=1000, attrs=None, 
+                shard_size=10000, num_pool=4, block_size=None):
+    """Rank users shard by shard on workers, each shard is written to 
+    its own segment as soon as it is done, so memory is bounded by 
+    num_pool shards. Load the directory by `load`.
+    users: users to dump, default all, `changed_users` for a refresh.
+    shard_size: number of users of a shard.
+    other arguments see `dump`, a worker scores its shard by `rank_batch`
+    if the model supports, else by `predict`.
+    return: dumped users.
+    """
+    if model is None:
+        raise ValueError("model is None.") 
+
+    t0 = time.time()
+    if users is None:
+        users = np.arange(model.num_users)
+    users = np.unique(np.asarray(users, dtype=int))
+    manifest, owner, fingerprints = _prepare(model, directory)
+    first = manifest["next"]
+    shards = [(first + k, users[start: start + shard_size]) for k, start 
+              in enumerate(xrange(0, len(users), shard_size))]
+    meta = _meta(model, attrs)
+    state = (model, num, block_size, directory, meta)
+    done = 0
+    # one pool per dump, see `_rank`
+    with Executor(num_pool, state=state) as executor:
+        for sid, n in executor.imap(_proxy_shard, shards, ordered=False):
+            done += n
+            t1 = time.time()
+            log.debug("shard %i done, %i/%i users, %.1f users/s" % 
+                      (sid, done, len(users), done / max(t1 - t0, 1e-6)))
+
+    current = _checkins(model).fingerprints()
+    for sid, shard in shards:
+        owner[shard] = sid
+        fingerprints[shard] = current[shard]
+    alive = _commit(directory, manifest, owner, fingerprints, meta, 
+                    first + len(shards))
+    t1 = time.time()
+    log.debug("dump shards, %i users, %i shards, %i segments, time: %.2fs" %
+              (len(users), len(shards), alive, t1 - t0))
+    return users
+
+
+def _load_directory(directory):
+    """Cache of segments in directory, opened lazily.
+    """
+    found = _read_manifest(directory)
+    if found is None:
+        raise ValueError("%s has no cache manifest." % directory)
+    manifest, owner, fingerprints = found
+    return SegmentRecommender(directory, manifest, owner)
+
+
 def load(fp):
     """Reture a cacherecommender, which is the tiny version of the 
     original one.
-    fp: file like object.
+    fp: file like object, or file name. Binary cache is memory mapped, 
+        see `dump_binary`, segments of a directory are merged, see
+        `dump_segment`.
     """
+    if isinstance(fp, basestring) and os.path.isdir(fp):
+        return _load_directory(fp)
+    if isinstance(fp, basestring):
+        with open(fp, "rb") as f:
+            binary = f.read(len(MAGIC)) == MAGIC
+        if binary:
+            return _load_binary(fp)
+        with open(fp) as f:
+            return load(f)
+
+    first = fp.read(len(MAGIC))
+    if first == MAGIC:
+        return _load_binary(fp.name)
     cr = CacheRecommender()
     # meta
-    cr._meta = json.loads(fp.readline())
+    cr._meta = json.loads(first + fp.readline())
     # recoreds
+    records = {}
     for line in fp:
         rd = json.loads(line.strip())
-        user = int(rd[0])
-        scores = rd[1]
-        cr._data[user] = {}
-        for l, s in scores:
-            cr._data[user][int(l)] = float(s)
+        records[int(rd[0])] = rd[1]
+    num_users = cr._meta.get("num_users", 0)
+    if len(records) > 0:
+        num_users = max(num_users, max(records) + 1)
+    num = max([len(pairs) for pairs in records.values()] + [0])
+    items = np.zeros((num_users, num), dtype=np.int32) - 1
+    scores = np.zeros((num_users, num)) - np.inf
+    for user, pairs in records.items():
+        for r, (l, s) in enumerate(pairs):
+            items[user, r] = int(l)
+            scores[user, r] = float(s)
+    cr._set_arrays(items, scores)
     return cr
-
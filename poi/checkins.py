@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""Compact checkin store.
+    `CheckinMatrix` keeps checkins in csr (and lazily csc) arrays with
+    int32 indices and float32 frequencies, and supports the dict like
+    lookups models use on `format_checkins` result:
+        user in checkins, item in checkins[user], checkins[user][item],
+        checkins[user].keys(), len(checkins[user]), for user in checkins.
+    usage:
+     >>> cks = CheckinMatrix.from_dict({0: [(1, 2), (2, 3)], 2: [1]})
+     >>> print cks.shape, 2 in cks, 1 in cks[0], 0 in cks[0]
+     (3, 3) True True False
+     >>> print cks[0].keys(), cks[0][2], len(cks[1]), cks.degree(2)
+     [1, 2] 3.0 0 1
+"""
+
+import logging
+
+import numpy as np
+try:
+    import scipy.sparse as sparse
+except:
+    pass
+
+__all__ = ["CheckinMatrix", "CheckinRow"]
+
+log = logging.getLogger(__name__)
+
+
+class CheckinRow(object):
+    """Read only {item: freq} view of one user's checkins.
+    """
+    __slots__ = ("_items", "_freqs")
+
+    def __init__(self, items, freqs):
+        self._items = items
+        self._freqs = freqs
+
+    def __repr__(self):
+        return "<CheckinRow %s>" % dict(self.items())
+
+    def _index(self, item):
+        i = np.searchsorted(self._items, item)
+        if i < len(self._items) and self._items[i] == item:
+            return i
+        return -1
+
+    def __contains__(self, item):
+        return self._index(item) >= 0
+
+    def __getitem__(self, item):
+        i = self._index(item)
+        if i < 0:
+            raise KeyError(item)
+        return float(self._freqs[i])
+
+    def get(self, item, default=None):
+        i = self._index(item)
+        if i < 0:
+            return default
+        return float(self._freqs[i])
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.tolist())
+
+    def keys(self):
+        return self._items.tolist()
+
+    def values(self):
+        return self._freqs.tolist()
+
+    def items(self):
+        return list(zip(self._items.tolist(), self._freqs.tolist()))
+
+
+class CheckinMatrix(object):
+    """Checkins of num_users users on num_items items.
+    csr: (num_users, num_items) scipy sparse matrix.
+    """
+    def __init__(self, csr):
+        # float32 csr arrays, memory mapped ones, are used without copy
+        if not sparse.isspmatrix_csr(csr) or csr.dtype != np.float32:
+            csr = sparse.csr_matrix(csr, dtype=np.float32)
+        csr.sum_duplicates()
+        csr.sort_indices()
+        csr.indices = csr.indices.astype(np.int32, copy=False)
+        if csr.nnz < 2 ** 31 - 1:
+            csr.indptr = csr.indptr.astype(np.int32, copy=False)
+        self.csr = csr
+        self._csc = None
+
+    @classmethod
+    def from_dict(cls, checkins, num_users=None, num_items=None):
+        """Build from {uid: [(iid, freq), ...]}, {uid: [iid, ...]} or
+        {uid: {iid: freq}}, see `load_checkins`, repeated item of a user
+        sum together. A CheckinMatrix is returned as it is.
+        """
+        if isinstance(checkins, cls):
+            return checkins
+        rows = []
+        cols = []
+        data = []
+        for user in checkins:
+            feedbacks = checkins[user]
+            if isinstance(feedbacks, dict):
+                feedbacks = feedbacks.items()
+            for feed in feedbacks:
+                if isinstance(feed, (int, long, np.integer)):
+                    item, freq = feed, 1.0
+                else:
+                    item, freq = feed[0], feed[1]
+                rows.append(user)
+                cols.append(item)
+                data.append(freq)
+        if num_users is None:
+            num_users = max(checkins) + 1 if len(checkins) > 0 else 0
+        if num_items is None:
+            num_items = max(cols) + 1 if len(cols) > 0 else 0
+        csr = sparse.csr_matrix((np.array(data, dtype=np.float32),
+                                 (np.array(rows, dtype=np.int32),
+                                  np.array(cols, dtype=np.int32))),
+                                shape=(num_users, num_items))
+        return cls(csr)
+
+    def __repr__(self):
+        return "<CheckinMatrix [users=%i, items=%i, nnz=%i]>" % \
+            (self.num_users, self.num_items, self.nnz)
+
+    def __getstate__(self):
+        return {"csr": self.csr}
+
+    def __setstate__(self, state):
+        self.csr = state["csr"]
+        self._csc = None
+
+    @property
+    def shape(self):
+        return self.csr.shape
+
+    @property
+    def num_users(self):
+        return self.csr.shape[0]
+
+    @property
+    def num_items(self):
+        return self.csr.shape[1]
+
+    @property
+    def nnz(self):
+        return self.csr.nnz
+
+    @property
+    def csc(self):
+        """(num_users, num_items) csc matrix, built once when needed.
+        """
+        if self._csc is None:
+            self._csc = self.csr.tocsc()
+            self._csc.sort_indices()
+        return self._csc
+
+    def __contains__(self, user):
+        return isinstance(user, (int, long, np.integer)) and \
+            0 <= user < self.num_users
+
+    def __len__(self):
+        return self.num_users
+
+    def __iter__(self):
+        return iter(xrange(self.num_users))
+
+    def keys(self):
+        return range(self.num_users)
+
+    def row(self, user):
+        """Return (items, freqs) arrays of user, items are sorted.
+        """
+        lo, hi = self.csr.indptr[user], self.csr.indptr[user + 1]
+        return self.csr.indices[lo: hi], self.csr.data[lo: hi]
+
+    def __getitem__(self, user):
+        if user not in self:
+            raise KeyError(user)
+        return CheckinRow(*self.row(user))
+
+    def degree(self, user=None):
+        """Number of items checked in by user, all users if None.
+        """
+        if user is None:
+            return np.diff(self.csr.indptr)
+        return int(self.csr.indptr[user + 1] - self.csr.indptr[user])
+
+    def fingerprints(self):
+        """uint64 hash of each user's checkins, changes when an item or 
+        frequency of the user changes, see `cache.changed_users`.
+        """
+        csr = self.csr
+        items = csr.indices.astype(np.uint64) + np.uint64(1)
+        freqs = np.asarray(csr.data, dtype=np.float32).view(np.uint32)
+        # mix item and frequency, sum of a row is order free
+        h = items * np.uint64(0x9E3779B97F4A7C15)
+        h ^= freqs.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+        h ^= h >> np.uint64(29)
+        # wrap around sums, row sum is still end - start modulo 2^64
+        cums = np.zeros(len(h) + 1, dtype=np.uint64)
+        np.cumsum(h, dtype=np.uint64, out=cums[1:])
+        indptr = csr.indptr.astype(np.int64)
+        sums = cums[indptr[1:]] - cums[indptr[: -1]]
+        return sums ^ np.diff(indptr).astype(np.uint64)
+
+    def item_degree(self, item=None):
+        """Number of users checked in item, all items if None.
+        """
+        if item is None:
+            return np.diff(self.csc.indptr)
+        return int(self.csc.indptr[item + 1] - self.csc.indptr[item])
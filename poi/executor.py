@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Long lived process pool.
+    Large read only state (model, checkins, ...) is shipped to each worker
+    once by the pool initializer, with fork it is simply inherited, tasks
+    only carry small arguments and read the state by `get_state`.
+    usage:
+    >>> def _square(i):
+    ...     return get_state()[i] ** 2
+    >>> with Executor(num=0, state=[1, 2, 3]) as executor:
+    ...     print executor.map(_square, [0, 2])
+    [1, 9]
+"""
+
+import logging
+from multiprocessing import Pool
+
+__all__ = ["Executor", "get_state"]
+
+log = logging.getLogger(__name__)
+
+# state of current process, set by Executor
+_state = {}
+
+
+def _initializer(state):
+    _state["value"] = state
+
+
+def get_state():
+    """Return the state of the Executor this process works for.
+    """
+    return _state.get("value")
+
+
+class Executor(object):
+    """Process pool with a state.
+    num  : number of processes, if 0, run tasks in current process.
+    state: shipped to workers once, see `get_state`.
+    """
+    def __init__(self, num=4, state=None):
+        self.num = num
+        self.state = state
+        self._previous = _state.get("value")
+        # set before fork, inline tasks and forked workers see it
+        _state["value"] = state
+        if num > 0:
+            self.pool = Pool(num, _initializer, (state, ))
+        else:
+            self.pool = None
+
+    def __repr__(self):
+        return "<Executor [num=%i]>" % self.num
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    def map(self, func, iterable, chunksize=None):
+        """Return list of func(arg), in order.
+        """
+        if self.pool is None:
+            return [func(arg) for arg in iterable]
+        return self.pool.map(func, iterable, chunksize)
+
+    def imap(self, func, iterable, chunksize=1, ordered=True):
+        """Iterate func(arg), args are sent to workers by chunks.
+        ordered: if False, yield results as soon as they are done.
+        """
+        if self.pool is None:
+            return (func(arg) for arg in iterable)
+        if ordered:
+            return self.pool.imap(func, iterable, chunksize)
+        return self.pool.imap_unordered(func, iterable, chunksize)
+
+    def close(self):
+        """Wait all tasks done, then stop workers.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        _state["value"] = self._previous
+
+    def terminate(self):
+        """Stop workers immediately.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        _state["value"] = self._previous
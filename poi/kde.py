@@ -1,14 +1,32 @@
 # -*- coding: utf-8 -*-
 
 import math
+import time
+import logging
 import numpy as np
-from .loader import tomatrix
+try:
+    import scipy.sparse as sparse
+    from scipy.ndimage import convolve1d
+except:
+    pass
+from .utils import tomatrix, topn_rows
 from .models import Recommender
+from .geo import EARTH_RADIUS, radians, iter_distances
+from .spatial import SpatialIndex
+from .lru import ScoreCache
 
-__all__ = ["distance", "KDE", "KDEModel"]
+__all__ = ["distance", "KDE", "KDEModel", "MODES", "kde_accuracy"]
+
+log = logging.getLogger(__name__)
+
+# density modes of `KDE.density_batch`
+MODES = ("exact", "truncated", "grid")
+# km of one degree latitude
+KM_PER_DEGREE = EARTH_RADIUS * math.pi / 180.0 / 1000.0
 
 def distance(point_x, point_y):  
-    """distance between two point, unit is meter
+    """distance between two point, unit is meter, see `poi.geo` for
+        the vectorized version.
         usage:
         >>> print distance((1.0, 0.0), (0.0, 0.0)) 
         111319.490793
@@ -36,17 +54,46 @@ class KDE(object):
         >>> print k.probility(0, 1) 
         0.398893835041
     """
-    def __init__(self, checkins, locations, smooth=1.0):
+    def __init__(self, checkins, locations, smooth=1.0, mode="exact", 
+                 cutoff=4.0, cell=None, max_cells=4000000):
         """
-        matrix : user checkin data sparse matrix
+        checkins: see poi.load_checkins method, or a `CheckinMatrix`
         locations: poi latitude and longitude
                    {"loc1": (20.0, 30.0), ...}
+        mode  : density of `density_batch`, `probility` is always exact.
+                "exact"    : kernels of all (poi, item) pairs.
+                "truncated": kernels of pairs within cutoff * smooth km,
+                             found by a `SpatialIndex`, others are 0.0.
+                "grid"     : pois binned on a lat/lon grid of cell km,
+                             convolved by the kernel truncated at 
+                             cutoff * smooth km, items interpolate
+                             their cells.
+        cutoff: in unit of smooth, see mode.
+        cell  : grid cell size km, default smooth / 4.
+        max_cells: grid larger than it is refused.
         """
         self.matrix = tomatrix(checkins)
         self.locations = locations
         if smooth <= 0.0:
             raise ValueError("smooth should > 0.0")
+        if mode not in MODES:
+            raise ValueError("mode should be one of %s." % (MODES, ))
         self.smooth = smooth
+        self.mode = mode
+        self.cutoff = cutoff
+        self.cell = cell if cell is not None else smooth / 4.0
+        self.max_cells = max_cells
+        self._coords = None
+        self._index = None
+        self._grid = None
+
+    @property
+    def coords(self):
+        """radians of items, see `poi.geo.radians`, built once.
+        """
+        if self._coords is None:
+            self._coords = radians(self.locations, self.matrix.shape[1])
+        return self._coords
 
     def probility(self, user, item):
         pois = set(np.nonzero(self.matrix[user])[1])
@@ -63,12 +110,229 @@ class KDE(object):
             sum_prob += prob
         return sum_prob / (math.sqrt(2.0 * math.pi) * self.smooth * len(pois))
 
+    def kernel_sums(self, indicator, pois, block_size=256):
+        """Gaussian kernel sums of rows of indicator to all items. 
+        indicator: (num_rows, len(pois)) csr, which pois each row has.
+        Kernels are computed for block_size pois at a time, and summed 
+        into the (num_rows, num_items) result, peak memory is 
+        block_size * num_items besides it.
+        """
+        coords = self.coords
+        columns = indicator.tocsc()
+        sums = np.zeros((indicator.shape[0], len(coords)))
+        for start, end, dis in iter_distances(coords[pois], coords, 
+                                              block_size):
+            x = dis / 1000.0 / self.smooth
+            sums += columns[:, start: end].dot(np.exp(-0.5 * x * x))
+        return sums
+
+    def kernel_truncated(self, pois):
+        """(len(pois), num_items) csr kernel of pairs within cutoff.
+        """
+        if self._index is None:
+            self._index = SpatialIndex(self.coords)
+        radius = self.cutoff * self.smooth * 1000.0
+        kernel = self._index.within(self.coords[pois], radius)
+        x = kernel.data / 1000.0 / self.smooth
+        kernel.data = np.exp(-0.5 * x * x)
+        return kernel
+
+    def grid(self):
+        """(shape, corners, shares, weights) built once. 
+        shape  : grid shape.
+        corners: (num_items, 4) cells around each item, -1 if no location.
+        shares : (num_items, 4) bilinear shares of the corners.
+        weights: the 1d kernel on cells.
+        """
+        if self._grid is not None:
+            return self._grid
+        degrees = np.degrees(self.coords)
+        valid = ~np.isnan(degrees).any(axis=1)
+        lat0 = np.radians(degrees[valid, 0].mean()) if valid.any() else 0.0
+        # local equirectangular projection, in cells
+        y = degrees[valid, 0] * KM_PER_DEGREE / self.cell
+        x = degrees[valid, 1] * KM_PER_DEGREE * math.cos(lat0) / self.cell
+        corners = np.zeros((len(degrees), 4), dtype=np.int64) - 1
+        shares = np.zeros((len(degrees), 4))
+        shape = (0, 0)
+        if valid.any():
+            y -= y.min()
+            x -= x.min()
+            shape = (int(y.max()) + 2, int(x.max()) + 2)
+            if shape[0] * shape[1] > self.max_cells:
+                raise ValueError("grid of %i x %i cells is too large, "
+                                 "use a larger cell." % shape)
+            iy, ix = np.floor(y).astype(np.int64), np.floor(x).astype(np.int64)
+            fy, fx = y - iy, x - ix
+            cell = iy * shape[1] + ix
+            corners[valid] = np.column_stack((cell, cell + 1, cell + shape[1],
+                                              cell + shape[1] + 1))
+            shares[valid] = np.column_stack(((1 - fy) * (1 - fx), 
+                                             (1 - fy) * fx, fy * (1 - fx), 
+                                             fy * fx))
+        half = int(math.ceil(self.cutoff * self.smooth / self.cell))
+        x = np.arange(-half, half + 1) * self.cell / self.smooth
+        weights = np.exp(-0.5 * x * x)
+        self._grid = (shape, corners, shares, weights)
+        log.debug("kde grid %i x %i, cell %.3fkm" % 
+                  (shape[0], shape[1], self.cell))
+        return self._grid
+
+    def _grid_sums(self, rows):
+        """Kernel sums of each csr row of pois, by grid convolution.
+        A poi is split to its 4 corner cells (linear binning), an item 
+        reads its 4 corners back (bilinear interpolation).
+        """
+        shape, corners, shares, weights = self.grid()
+        sums = np.zeros((rows.shape[0], len(corners)))
+        valid = corners[:, 0] >= 0
+        for r in xrange(rows.shape[0]):
+            pois = rows.indices[rows.indptr[r]: rows.indptr[r + 1]]
+            pois = pois[valid[pois]]
+            if len(pois) == 0:
+                continue
+            counts = np.bincount(corners[pois].ravel(), 
+                                 weights=shares[pois].ravel(),
+                                 minlength=shape[0] * shape[1])
+            conv = convolve1d(counts.reshape(shape), weights,
+                              axis=0, mode="constant")
+            conv = convolve1d(conv, weights, axis=1, mode="constant").ravel()
+            sums[r, valid] = (conv[corners[valid]] * shares[valid]).sum(axis=1)
+        return sums
+
+    def density_batch(self, users):
+        """`probility` of users to all items, (len(users), num_items),
+        approximated by mode.
+        Kernels of the union of the users' pois are computed once, 
+        block by block, a binary csr of users' pois sums them.
+        Pois without location are ignored, items without location are 0.0.
+        """
+        rows = self.matrix[np.asarray(users, dtype=int)].tocsr()
+        rows.eliminate_zeros()
+        located = ~np.isnan(self.coords).any(axis=1)
+        visited = np.repeat(np.arange(rows.shape[0]), np.diff(rows.indptr))
+        visited = (visited, rows.indices.copy())
+        # pois without location are left out of the kernel sums
+        rows.data = located[rows.indices].astype(float)
+        rows.eliminate_zeros()
+        pois = np.unique(rows.indices)
+        counts = np.diff(rows.indptr)
+        indicator = sparse.csr_matrix((np.ones(len(rows.indices)), 
+                                       np.searchsorted(pois, rows.indices),
+                                       rows.indptr), 
+                                      shape=(len(counts), len(pois)))
+        norm = math.sqrt(2.0 * math.pi) * self.smooth * np.maximum(counts, 1)
+        if self.mode == "exact":
+            sums = self.kernel_sums(indicator, pois)
+        elif self.mode == "truncated":
+            sums = indicator.dot(self.kernel_truncated(pois)).toarray()
+        else:
+            sums = self._grid_sums(rows)
+        probs = sums / norm[:, None]
+        probs[counts == 0] = 1.0
+        probs[:, ~located] = 0.0
+        probs[visited] = 1.0
+        return probs
+
+    def density(self, user):
+        """`probility` of user to all items.
+        """
+        return self.density_batch([user])[0]
+
 
 class KDEModel(Recommender):
-    def __init__(self, checkins, locations, smooth=1.0):
+    """KDE recommender, densities of a user to all items are computed 
+    at once, the cache_size most recently used users are kept, see
+    `poi.lru.ScoreCache` for spill. Densities are cached as float64, 
+    far items are far below the float32 range.
+    mode, cutoff, cell: approximation, see `KDE`.
+    usage:
+     >>> cks = {0: [0], 1: [1]}
+     >>> locs = {0: (0.0, 0.0), 1: (0.1, 0.0)}
+     >>> m = KDEModel(cks, locs, smooth=0.5)
+     >>> p = m.kde.probility(0, 1)
+     >>> print p < 1e-100, abs(m.predict(0, 1) - p) < 1e-9 * p
+     True True
+    """
+    def __init__(self, checkins, locations, smooth=1.0, cache_size=1024,
+                 mode="exact", cutoff=4.0, cell=None, spill=None):
         super(KDEModel, self).__init__(checkins)
-        self.kde = KDE(checkins, locations, smooth)
+        self.kde = KDE(self.checkins, locations, smooth, mode, cutoff, cell)
+        self._cache = ScoreCache(self.num_items, cache_size, 
+                                 dtype=np.float64, spill=spill,
+                                 num_users=self.num_users)
 
     def predict(self, user, item):
-        return self.kde.probility(user, item)
+        return float(self.score_all(user)[item])
+
+    def score_all(self, user):
+        return self._cache.fetch(user, self.kde.density)
+
+    def score_batch(self, users):
+        """Densities of users, cached ones are read from the cache, the
+        others are computed together and stored to it.
+        """
+        users = list(users)
+        scores = np.zeros((len(users), self.num_items))
+        missing = []
+        for r, user in enumerate(users):
+            cached = self._cache.get(user)
+            if cached is None:
+                missing.append(r)
+            else:
+                scores[r] = cached
+        if len(missing) > 0:
+            users = np.asarray(users)[missing]
+            scores[missing] = self.kde.density_batch(users)
+            for r, user in zip(missing, users):
+                self._cache.put(user, scores[r])
+        return scores
+
+
+
+def kde_accuracy(checkins, locations, smooth=1.0, users=None, num=10,
+                 modes=("truncated", "grid"), **kwargs):
+    """Compare approximate modes with the exact one on users.
+    kwargs: cutoff, cell, see `KDE`.
+    return: {mode: {"max_abs", "max_rel", "topn", "time"}}, max_rel is
+            relative to the max density of the user, topn is the mean 
+            overlap of top num unvisited items, time is seconds.
+    """
+    exact = KDE(checkins, locations, smooth)
+    if users is None:
+        users = np.arange(exact.matrix.shape[0])
+    users = np.asarray(users, dtype=int)
+    matrix = exact.matrix[users]
+
+    rows, cols = matrix.nonzero()
+
+    def _rank(probs):
+        probs = probs.copy()
+        probs[rows, cols] = -np.inf
+        return topn_rows(probs, num)
 
+    t0 = time.time()
+    truth = exact.density_batch(users)
+    report = {"exact": {"time": time.time() - t0}}
+    top_truth = _rank(truth)
+    unvisited = truth.copy()
+    unvisited[rows, cols] = 0.0
+    scale = np.maximum(unvisited.max(axis=1), 1e-300)
+    for mode in modes:
+        kde = KDE(checkins, locations, smooth, mode, **kwargs)
+        t0 = time.time()
+        probs = kde.density_batch(users)
+        t1 = time.time()
+        error = np.abs(probs - truth)
+        top = _rank(probs)
+        overlap = [len(set(a[a >= 0]) & set(b[b >= 0])) / float(num) 
+                   for a, b in zip(top, top_truth)]
+        report[mode] = {"max_abs": float(error.max()),
+                        "max_rel": float((error.max(axis=1) / scale).max()),
+                        "topn": float(np.mean(overlap)), "time": t1 - t0}
+        log.info("kde %-9s max abs %.2e, max rel %.2e, top%i %.4f, "
+                 "time %.2fs (exact %.2fs)" % 
+                 (mode, report[mode]["max_abs"], report[mode]["max_rel"], 
+                  num, report[mode]["topn"], t1 - t0, 
+                  report["exact"]["time"]))
+    return report
@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
 import logging
 
+import numpy as np
+try:
+    import scipy.sparse as sparse
+except:
+    pass
+
+from .checkins import CheckinMatrix
+
 log = logging.getLogger(__name__)
 
-__all__ = ["load_checkins", "load_locations"]
+__all__ = ["load_checkins", "load_locations", "load_table", 
+           "bulk_load_checkins", "bulk_load_locations"]
+
+# bump when the parsed table layout changes, old caches are ignored
+CACHE_VERSION = 1
 
 def load_checkins(infile, index=None, repeat=True):
     """Load checkins data from file.
@@ -68,6 +81,7 @@ def format_checkins(checkins):
     checkins: {uid: [(iid, freq), ...], ...} or {uid: [uid, ...], ...},
              see `load_checkins` for detail.
     return: number of item, num of user, checkins in dict
+    Models keep checkins as a compact `CheckinMatrix` instead.
     usage:
      >>> cks = {0: [1, 2], 1: [1]} 
      >>> print format_checkins(cks) 
@@ -124,3 +138,142 @@ def load_locations(infile, index=None):
         locations[item] = (lat, lon)
     return locations
  
+
+
+def _read_cache(filename, stat):
+    cache = filename + ".npz"
+    if not os.path.exists(cache):
+        return None
+    try:
+        data = np.load(cache)
+        key = (int(data["version"]), float(data["mtime"]), int(data["size"]))
+        if key == (CACHE_VERSION, stat.st_mtime, stat.st_size):
+            return data["table"]
+    except Exception as e:
+        log.warning("bad cache %s: %s" % (cache, e))
+    return None
+
+
+def _write_cache(filename, stat, table):
+    cache = filename + ".npz"
+    try:
+        with open(cache, "wb") as fp:
+            np.savez(fp, table=table, version=CACHE_VERSION, 
+                     mtime=stat.st_mtime, size=stat.st_size)
+    except (IOError, OSError) as e:
+        log.warning("can not write cache %s: %s" % (cache, e))
+
+
+def parse_table(text):
+    """Parse text into a two dim float array, see `load_table`.
+    """
+    text = text.replace(",", " ").replace(":", " ")
+    first = text.lstrip().split("\n", 1)[0]
+    num_cols = len(first.split())
+    if num_cols == 0:
+        return np.zeros((0, 0))
+    values = np.fromstring(text, sep=" ")
+    if len(values) % num_cols != 0:
+        raise ValueError("lines have different number of columns.")
+    return values.reshape(-1, num_cols)
+
+
+def load_table(infile, cache=True):
+    """Parse a file of numbers into a two dim float array at once.
+    Space, tab, "," and ":" all separate columns, so "lat,lon" gives
+    two columns, "hh:mm" as well.
+    infile: file name, or a file object (never cached).
+    cache : if True, parsed table is saved to `infile + ".npz"`, which
+            is reused while version, mtime and size of infile unchanged.
+    usage:
+     >>> import StringIO
+     >>> s = StringIO.StringIO("0\\t1\\t1.5,2.5\\t08:30\\n1\\t3\\t2.0,3.0\\t09:00\\n")
+     >>> print load_table(s)
+     [[  0.    1.    1.5   2.5   8.   30. ]
+      [  1.    3.    2.    3.    9.    0. ]]
+    """
+    t0 = time.time()
+    if hasattr(infile, "read"):
+        text = infile.read()
+        filename = None
+    else:
+        filename = infile
+        stat = os.stat(filename)
+        if cache:
+            table = _read_cache(filename, stat)
+            if table is not None:
+                log.debug("load %s from cache, time %.4f seconds" % 
+                          (filename, time.time() - t0))
+                return table
+        with open(filename) as fp:
+            text = fp.read()
+
+    table = parse_table(text)
+
+    if filename is not None and cache:
+        _write_cache(filename, stat, table)
+    log.debug("parse %i lines, time %.4f seconds" % 
+              (len(table), time.time() - t0))
+    return table
+
+
+def bulk_load_checkins(infile, index=None, repeat=True, cache=True):
+    """Same as `load_checkins`, but parse by `load_table` and return 
+    a `CheckinMatrix`.
+    index : columns of (uid, iid) or (uid, iid, freq) in the table,
+            see `load_table` for how columns are split.
+    usage:
+     >>> import StringIO
+     >>> s = StringIO.StringIO("0 1 2\\n0 1 3\\n2 2 4\\n")
+     >>> cks = bulk_load_checkins(s, index=[0, 1, 2])
+     >>> print cks[0].items(), cks[2].items()
+     [(1, 5.0)] [(2, 4.0)]
+    """
+    if index is None:
+        index = (0, 1)
+    t0 = time.time()
+    table = load_table(infile, cache)
+    users = table[:, index[0]].astype(np.int64)
+    items = table[:, index[1]].astype(np.int64)
+    if len(index) >= 3:
+        freqs = table[:, index[2]]
+    else:
+        freqs = np.ones(len(table))
+
+    if not repeat and len(table) > 0:
+        # keep the last record of each (user, item)
+        keys = users * (items.max() + 1) + items
+        unique, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        users, items, freqs = users[last], items[last], freqs[last]
+
+    num_users = int(users.max()) + 1 if len(users) > 0 else 0
+    num_items = int(items.max()) + 1 if len(items) > 0 else 0
+    # duplicates sum together
+    csr = sparse.csr_matrix((freqs, (users, items)), 
+                            shape=(num_users, num_items))
+    checkins = CheckinMatrix(csr)
+    t1 = time.time()
+    log.debug("load %i checkins, %i users, %i pois." % 
+              (len(table), len(np.unique(users)), len(np.unique(items))))
+    log.debug('time %.4f seconds' % (t1 - t0))
+    return checkins
+
+
+def bulk_load_locations(infile, index=None, cache=True):
+    """Same as `load_locations`, but parse by `load_table`.
+    index: columns of (loc, lantitude, longititude) in the table.
+    usage:
+     >>> import StringIO
+     >>> s = StringIO.StringIO("0 1.0 2.0\\n1 1.0 3.0\\n")
+     >>> print bulk_load_locations(s)
+     {0: (1.0, 2.0), 1: (1.0, 3.0)}
+    """
+    if index is None:
+        index = (0, 1, 2)
+    table = load_table(infile, cache)
+    items = table[:, index[0]].astype(np.int64).tolist()
+    lats = table[:, index[1]].tolist()
+    lons = table[:, index[2]].tolist()
+    # later line wins, like load_locations
+    return dict(zip(items, zip(lats, lons)))
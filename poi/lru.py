@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""Least recently used caches.
+    LRUCache  : any values.
+    ScoreCache: per user score vectors of a model, float32 by default,
+                bounded by users or bytes, evicted ones may spill to a
+                memory mapped file, see `ScoreCache`.
+    usage:
+     >>> cache = LRUCache(2)
+     >>> cache[0] = "a"
+     >>> cache[1] = "b"
+     >>> print cache.get(0)
+     a
+     >>> cache[2] = "c"
+     >>> print 1 in cache, cache.get(1), len(cache)
+     False None 2
+"""
+
+import os
+import logging
+import weakref
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ["LRUCache", "ScoreCache"]
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """Keep at most capacity values, the least recently used one is
+    evicted first. capacity 0 keeps nothing.
+    on_evict: called as on_evict(key, value) for each evicted value.
+    """
+    def __init__(self, capacity=1024, on_evict=None):
+        if capacity < 0:
+            raise ValueError("capacity should >= 0.")
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+
+    def __repr__(self):
+        return "<LRUCache [%i/%i]>" % (len(self._data), self.capacity)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        # move to the most recent end
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        self._data[key] = value
+        while len(self._data) > self.capacity:
+            key, value = self._data.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def clear(self):
+        self._data.clear()
+
+
+class ScoreCache(object):
+    """Score vectors of users on num_items items.
+    capacity : max users kept in memory.
+    max_bytes: if assign, capacity is the users fit in max_bytes.
+    dtype    : of stored vectors.
+    spill    : True or a file name, evicted vectors are written to a 
+               (num_users, num_items) memory mapped file and read back 
+               on a later miss, a temporary file if True.
+    num_users: rows of the spill file, required by spill.
+    The spill file is opened on the first spill of each process, a forked
+    process does not write to the file of its parent, a named file gets
+    a ".<pid>" suffix out of the process which created the cache. close(),
+    also called on exit of a with block and by the garbage collector,
+    removes the file of this process.
+    usage:
+     >>> cache = ScoreCache(3, capacity=1)
+     >>> print cache.fetch(0, lambda u: [0.5, 1.0, 2.0])
+     [ 0.5  1.   2. ]
+     >>> print cache.get(0).dtype, cache.get(1), cache.hits, cache.misses
+     float32 None 1 2
+    """
+    def __init__(self, num_items, capacity=1024, max_bytes=None, 
+                 dtype=np.float32, spill=None, num_users=None):
+        self.num_items = num_items
+        self.dtype = np.dtype(dtype)
+        if max_bytes is not None:
+            row = max(1, num_items * self.dtype.itemsize)
+            capacity = max(1, int(max_bytes // row))
+        if spill and num_users is None:
+            raise ValueError("spill need num_users.")
+        self.capacity = capacity
+        self.spill = spill
+        self.num_users = num_users
+        self._owner = os.getpid()
+        self._init()
+
+    def _init(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # a bound method would make a cycle, python 2 never collects a
+        # cycle with __del__
+        ref = weakref.ref(self)
+        self._memory = LRUCache(self.capacity, 
+                                on_evict=lambda u, s: ref()._evict(u, s))
+        self._file = None
+        # process which opened _file
+        self._pid = None
+        self._spilled = None
+        self._stored = None
+
+    def __repr__(self):
+        return "<ScoreCache [%i/%i, hits=%i, misses=%i]>" % \
+            (len(self._memory), self.capacity, self.hits, self.misses)
+
+    def __getstate__(self):
+        # cached scores are derived data, not pickled
+        state = self.__dict__.copy()
+        for key in ("_memory", "_file", "_pid", "_spilled", "_stored"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init()
+
+    def __del__(self):
+        if hasattr(self, "_pid"):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __contains__(self, user):
+        return user in self._memory or \
+            (self._spill_ready() and self._stored[user])
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total > 0 else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, 
+                "evictions": self.evictions, "size": len(self._memory),
+                "capacity": self.capacity, "hit_rate": self.hit_rate}
+
+    def _evict(self, user, scores):
+        self.evictions += 1
+        if not self.spill:
+            return
+        if not self._spill_ready():
+            pid = os.getpid()
+            if self.spill is True:
+                fd, self._file = tempfile.mkstemp(suffix=".scores")
+                os.close(fd)
+            elif pid != self._owner:
+                self._file = "%s.%i" % (self.spill, pid)
+            else:
+                self._file = self.spill
+            self._pid = pid
+            self._spilled = np.memmap(self._file, dtype=self.dtype, 
+                                      mode="w+", shape=(self.num_users, 
+                                                        self.num_items))
+            self._stored = np.zeros(self.num_users, dtype=bool)
+        self._spilled[user] = scores
+        self._stored[user] = True
+
+    def get(self, user):
+        """Scores of user, None if not cached.
+        """
+        scores = self._memory.get(user)
+        if scores is None and self._spill_ready() and self._stored[user]:
+            scores = np.array(self._spilled[user])
+            self._memory[user] = scores
+        if scores is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return scores
+
+    def put(self, user, scores):
+        """Store scores of user, return the stored vector.
+        """
+        scores = np.array(scores, dtype=self.dtype)
+        if self.capacity > 0:
+            self._memory[user] = scores
+        return scores
+
+    def fetch(self, user, compute):
+        """Scores of user, compute(user) and store them if not cached.
+        """
+        scores = self.get(user)
+        if scores is None:
+            scores = self.put(user, compute(user))
+        return scores
+
+    def _spill_ready(self):
+        """True if the spill file of this process is open, the one 
+        inherited from a parent process is dropped, not removed.
+        """
+        if self._spilled is not None and self._pid != os.getpid():
+            self._file = None
+            self._pid = None
+            self._spilled = None
+            self._stored = None
+        return self._spilled is not None
+
+    def clear(self):
+        self._memory.clear()
+        if self._spill_ready():
+            self._stored[:] = False
+
+    def close(self):
+        """Remove the spill file of this process, spilled scores are lost,
+        the cache is still usable.
+        """
+        if not self._spill_ready():
+            return
+        filename = self._file
+        self._file = None
+        self._pid = None
+        self._spilled = None
+        self._stored = None
+        if os.path.exists(filename):
+            os.remove(filename)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""Ranking metrics over a top-N matrix.
+    topn : (num_users, N) int array, recommended items of each user,
+           best first, -1 for empty position, see `recommend_batch`.
+    truth: (num_users, num_items) csr matrix of test checkins,
+           row r is the truth of topn[r].
+    All metrics of several k are computed from one ranking, and are
+    averaged over all rows, like `Evaluation.assess`.
+"""
+
+import logging
+
+import numpy as np
+
+from .utils import csr_keys, in_keys
+
+__all__ = ["hit_matrix", "ranking_metrics"]
+
+log = logging.getLogger(__name__)
+
+
+def hit_matrix(topn, truth):
+    """Whether each recommended item is in the truth.
+    return: bool array, same shape as topn.
+    usage:
+     >>> from scipy.sparse import csr_matrix
+     >>> truth = csr_matrix([[0, 1, 1], [1, 0, 0]])
+     >>> print hit_matrix(np.array([[2, 0], [0, -1]]), truth)
+     [[ True False]
+      [ True False]]
+    """
+    topn = np.asarray(topn)
+    num_rows, num = topn.shape
+    num_cols = truth.shape[1]
+    rows = np.repeat(np.arange(num_rows), num)
+    cols = topn.ravel()
+    # item out of truth matrix never hit
+    valid = (cols >= 0) & (cols < num_cols)
+    hits = np.zeros(num_rows * num, dtype=bool)
+    hits[valid] = in_keys(csr_keys(truth), rows[valid], cols[valid],
+                          num_cols)
+    return hits.reshape(num_rows, num)
+
+
+def ranking_metrics(topn, truth, ks=(5, 10), num_items=None):
+    """Compute precision, recall, ndcg, map, hit rate and coverage at k.
+    ks       : cut off positions, each k <= N.
+    num_items: size of the catalog for coverage, default truth.shape[1].
+    return: {"precision@5": 0.1, ...}
+    usage:
+     >>> from scipy.sparse import csr_matrix
+     >>> truth = csr_matrix([[0, 1, 1], [1, 0, 0]])
+     >>> m = ranking_metrics(np.array([[2, 0], [0, -1]]), truth, ks=[1, 2])
+     >>> print m["precision@1"], m["recall@2"], m["hit@2"]
+     1.0 0.75 1.0
+     >>> print round(m["ndcg@2"], 4), m["map@2"], m["coverage@2"]
+     0.8066 0.75 0.666666666667
+    """
+    topn = np.asarray(topn)
+    if num_items is None:
+        num_items = truth.shape[1]
+    num_rows, num = topn.shape
+    hits = hit_matrix(topn, truth).astype(float)
+    sizes = np.diff(truth.tocsr().indptr).astype(float)
+    has_truth = sizes > 0
+    safe_sizes = np.where(has_truth, sizes, 1.0)
+
+    discount = 1.0 / np.log2(np.arange(num) + 2.0)
+    cum_hits = hits.cumsum(axis=1)
+    ranks = np.arange(1, num + 1, dtype=float)
+    # precision at each hit position, for average precision
+    hit_precision = hits * cum_hits / ranks
+
+    metrics = {}
+    for k in ks:
+        if k > num:
+            raise ValueError("k: %i larger than topN: %i." % (k, num))
+        nhits = cum_hits[:, k - 1]
+        metrics["precision@%i" % k] = nhits.sum() / (num_rows * k)
+        metrics["recall@%i" % k] = (nhits / safe_sizes).sum() / num_rows
+        metrics["hit@%i" % k] = (nhits > 0).sum() / float(num_rows)
+
+        dcg = (hits[:, : k] * discount[: k]).sum(axis=1)
+        ideal = np.cumsum(discount[: k])
+        idcg = ideal[np.minimum(sizes, k).astype(int) - 1]
+        ndcg = np.where(has_truth, dcg / np.where(has_truth, idcg, 1.0), 0.0)
+        metrics["ndcg@%i" % k] = ndcg.sum() / num_rows
+
+        ap = hit_precision[:, : k].sum(axis=1) / np.minimum(safe_sizes, k)
+        metrics["map@%i" % k] = ap.sum() / num_rows
+
+        items = topn[:, : k]
+        covered = np.unique(items[items >= 0])
+        metrics["coverage@%i" % k] = len(covered) / float(num_items)
+    return metrics
@@ -5,8 +5,10 @@ import logging
 
 import numpy as np
 
-from .loader import format_checkins
-from .utils import threads
+from .checkins import CheckinMatrix
+from .utils import topn, topn_rows, tomatrix
+from .executor import Executor, get_state
+from .metrics import ranking_metrics
 
 log = logging.getLogger(__name__)
 
@@ -14,13 +16,21 @@ __all__ = ["Recommender", "Evaluation"]
 
 class Recommender(object):
     """Recommender Base class.
+    Subclass may provide `score_all(user)`, which returns scores of all
+    items as a numpy array, and `score_batch(users)`, which returns a
+    (len(users), num_items) matrix. `recommend` use them when exist, 
+    instead of calling `predict` for each item.
+    block_size: number of users scored together by `recommend_batch`,
+                bound the peak memory to block_size * num_items scores.
     """
+    block_size = 256
+
     def __init__(self, checkins=None):
         super(Recommender, self).__init__()
         if checkins is not None:
-            self.checkins = checkins
-            result = format_checkins(checkins) 
-            self.num_users, self.num_items, self.checkins = result 
+            # shared, if checkins is already a CheckinMatrix
+            self.checkins = CheckinMatrix.from_dict(checkins)
+            self.num_users, self.num_items = self.checkins.shape
         else:
             self.checkins = {} 
 
@@ -36,6 +46,15 @@ class Recommender(object):
         else:
             ruleouts = set()
 
+        score_all = getattr(self, "score_all", None)
+        if score_all is not None:
+            # copy, model may return a cached vector
+            scores = np.array(score_all(user), dtype=float)
+            if len(ruleouts) > 0:
+                scores[list(ruleouts)] = -np.inf
+            num = min(num, self.num_items - len(ruleouts))
+            return topn(scores, num).tolist()
+
         scores = []
         for poi in xrange(self.num_items):
             if poi in ruleouts:
@@ -46,16 +65,82 @@ class Recommender(object):
 
         return [poi for poi, s in scores[: num]] 
 
+    def score_block(self, users):
+        """Scores matrix (len(users), num_items) of users. 
+        Use `score_batch` or `score_all` if the model has, 
+        fall back to `predict`.
+        """
+        score_batch = getattr(self, "score_batch", None)
+        if score_batch is not None:
+            return np.array(score_batch(users), dtype=float)
+        score_all = getattr(self, "score_all", None)
+        if score_all is not None:
+            return np.array([score_all(u) for u in users], dtype=float)
+        scores = np.zeros((len(users), self.num_items))
+        for r, user in enumerate(users):
+            for poi in xrange(self.num_items):
+                scores[r, poi] = self.predict(user, poi)
+        return scores
+
+    def rank_batch(self, users, num=5, ruleout=True, block_size=None):
+        """Rank top num items for many users, block by block.
+        return: (items, scores), items is (len(users), num) int32 array,
+                -1 if the user has less than num items to recommend, 
+                scores is the corresponding scores.
+        """
+        if block_size is None:
+            block_size = self.block_size
+        users = np.asarray(users, dtype=int)
+        num = min(num, self.num_items)
+        if ruleout:
+            matrix = self.checkins.csr
+
+        items = np.zeros((len(users), num), dtype=np.int32)
+        scores = np.zeros((len(users), num))
+        for start in xrange(0, len(users), block_size):
+            block = users[start: start + block_size]
+            block_scores = self.score_block(block)
+            if ruleout:
+                rows, cols = matrix[block].nonzero()
+                block_scores[rows, cols] = -np.inf
+            index = topn_rows(block_scores, num)
+            rows = np.arange(len(block))[:, None]
+            end = start + len(block)
+            items[start: end] = index
+            scores[start: end] = block_scores[rows, index]
+            scores[start: end][index < 0] = -np.inf
+        return items, scores
+
+    def recommend_batch(self, users, num=5, ruleout=True, block_size=None):
+        """Recommend num items for each user in users.
+        return: (len(users), num) int32 array, -1 if not enough items.
+        """
+        items, scores = self.rank_batch(users, num, ruleout, block_size)
+        return items
+
+
+def batchable(model):
+    """Whether model can score many items at once, see `Recommender`.
+    """
+    return hasattr(model, "rank_batch") and \
+        (hasattr(model, "score_batch") or hasattr(model, "score_all"))
+
         
 def _proxy_test(args):
-    evaluation, user, full = args
-    bingos = evaluation.hits(user)
+    user, topN, full = args
+    evaluation = get_state()
+    bingos = evaluation.hits(user, topN)
     n = len(bingos)
     if full and n > 0:
         log.debug("user %i hit %s" % (user, bingos))
     return (user, n)
 
 
+def _proxy_recommend(args):
+    user, num = args
+    return get_state().model.recommend(user, num)
+
+
 class Evaluation(object):
     def __init__(self, 
                 checkins, 
@@ -66,12 +151,18 @@ class Evaluation(object):
                 full=True):
         """
         Evaluate a model.Report precision and recall.
-        checkins: test checkins, set `loader.load_checkins` method for more informations 
-        model: model for test, must has `recommend` methid
+        checkins: test checkins, set `loader.load_checkins` method for more informations,
+                  or a `CheckinMatrix`
+        model: model for test, must has `recommend` methid,
+               `recommend_batch` is used when the model can score 
+               all items at once, see `Recommender`.
         N    : recommend N pois
         users: users for test, should be iterated
         _pool_num: thread number to test, most cases default is ok.
-                    if 0, then turn off multiple threads.
+                    if 0, then turn off multiple threads. The pool is 
+                    forked by each assess, rank or report call, so 
+                    workers see the model as it is at the call, also 
+                    when it is trained in place.
         full: log hit record to screen and file, default True
         usage:
         >>> cks = {0: [1], 1:[0, 1], 2:[1,2]}
@@ -83,15 +174,27 @@ class Evaluation(object):
         >>> ev = Evaluation(cks, model=M(), users=[0, 1], _pool_num=0)
         >>> ev.assess()
         (0.5, 0.1)
+        >>> class Top(object):
+        ...     items = [1]
+        ...     def recommend(self, u, N):
+        ...         return self.items
+        >>> m = Top()
+        >>> ev = Evaluation(cks, model=m, users=[0, 1], _pool_num=2)
+        >>> ev.assess()
+        (0.75, 0.2)
+        >>> m.items = [0, 1]
+        >>> ev.assess()
+        (1.0, 0.3)
         """
-        result = format_checkins(checkins) 
-        self.num_users, self.num_items, self.checkins = result 
+        self.checkins = CheckinMatrix.from_dict(checkins)
+        self.num_users, self.num_items = self.checkins.shape
         self.topN = topN
         self.model = model
         self._pool_num = _pool_num
         self.full = full
         self.precision = 0.0 
         self.recall = 0.0 
+        self.metrics = {}
         if users is None:
             self.users = xrange(self.num_users)
         else:
@@ -101,20 +204,53 @@ class Evaluation(object):
         return "<Eval [N=%i, prec=%.4f, reca=%.4f]>" %\
                 (self.topN, self.precision, self.recall)
 
-    def hits(self, user):
+    def _imap(self, func, tasks):
+        """Run tasks on a pool forked now, workers see this evaluation 
+        by `get_state`.
+        """
+        tasks = list(tasks)
+        chunksize = max(1, len(tasks) // (max(self._pool_num, 1) * 8))
+        # a pool kept across calls would hold a model changed since
+        with Executor(max(self._pool_num, 0), state=self) as executor:
+            return list(executor.imap(func, tasks, chunksize))
+
+    def _set_model(self, model):
+        if model is not None:
+            self.model = model
+        if self.model is None:
+            raise ValueError("model is None.")
+
+    def hits(self, user, topN=None):
+        if topN is None:
+            topN = self.topN
         if user not in self.checkins:
             return []
         pois = set(self.checkins[user].keys())
         if len(pois) <= 0:
             return []
-        result = self.model.recommend(user, self.topN)
+        result = self.model.recommend(user, topN)
         return list(set(pois) & set(result))
 
+    def batch_hits(self, block_size=None):
+        """Same as `hits` for all users, but recommend by `recommend_batch`.
+        return: [(user, number of hits), ...]
+        """
+        users = [u for u in self.users 
+                 if u in self.checkins and len(self.checkins[u]) > 0]
+        result = self.model.recommend_batch(users, self.topN, 
+                                            block_size=block_size)
+        matchs = [(u, 0) for u in self.users 
+                  if u not in self.checkins or len(self.checkins[u]) == 0]
+        for r, user in enumerate(users):
+            bingos = list(set(self.checkins[user].keys()) & set(result[r].tolist()))
+            n = len(bingos)
+            if self.full and n > 0:
+                log.debug("user %i hit %s" % (user, bingos))
+            matchs.append((user, n))
+        return matchs
+
     def assess(self, model=None, topN=None, users=None, full=None):
-        if model is not None:
-            self.model = model
-        if self.model is None:
-            raise ValueError("model is None.")
+        self._set_model(model)
         if topN is not None:
             self.topN = topN
         if users is not None:
@@ -124,11 +260,12 @@ class Evaluation(object):
         
         t0 = time.time()
 
-        args = [(self, i, self.full) for i in self.users]
-        if self._pool_num > 0:
-            matchs = threads(_proxy_test, args, num=self._pool_num)
+        if batchable(self.model):
+            matchs = self.batch_hits()
         else:
-            matchs = [_proxy_test(arg) for arg in args]
+            # evaluation is shipped to workers once, tasks are user ids
+            matchs = self._imap(_proxy_test, [(u, self.topN, self.full) 
+                                              for u in self.users])
         
         nhits = sum([n for u, n in matchs])
         reca = 0.0
@@ -156,6 +293,45 @@ class Evaluation(object):
 
         return (reca, prec)
 
+    def rank(self, users, num):
+        """Top num items of each user, by `recommend_batch` if possible.
+        return: (len(users), num) int32 array, -1 for empty position.
+        """
+        users = list(users)
+        if batchable(self.model):
+            return self.model.recommend_batch(users, num)
+        results = self._imap(_proxy_recommend, [(u, num) for u in users])
+        topn = np.zeros((len(users), num), dtype=np.int32) - 1
+        for r, items in enumerate(results):
+            items = list(items)[: num]
+            topn[r, : len(items)] = items
+        return topn
+
+    def report(self, model=None, ks=(5, 10, 20), users=None):
+        """Evaluate precision, recall, ndcg, map, hit rate and coverage 
+        at each k in ks, all from one ranking of max(ks) items, 
+        see `poi.metrics`.
+        return: {"precision@5": 0.1, ...}, also kept as self.metrics.
+        """
+        self._set_model(model)
+        if users is not None:
+            self.users = users
+
+        t0 = time.time()
+        users = np.array(list(self.users), dtype=int)
+        if len(users) == 0:
+            raise ValueError("users should not be empty.")
+        topn = self.rank(users, max(ks))
+        num_rows = max(self.num_users, users.max() + 1)
+        truth = tomatrix(self.checkins, shape=(num_rows, self.num_items))
+        num_items = getattr(self.model, "num_items", self.num_items)
+        self.metrics = ranking_metrics(topn, truth[users], ks, num_items)
+        t1 = time.time()
+        for name in sorted(self.metrics):
+            log.info("%-13s: %.4f" % (name, self.metrics[name]))
+        log.info('time         : %.4fs' % (t1 - t0))
+        return self.metrics
+
 
 def assess(model, checkins, topN=None, users=None, full=None, num_pool=3):
     eva = Evaluation(checkins, model=model, _pool_num=num_pool)
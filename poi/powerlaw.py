@@ -5,6 +5,10 @@ import math
 import logging
 
 import numpy as np
+try:
+    import scipy.sparse as sparse
+except:
+    pass
 try:
     import matplotlib.pyplot as plt
     from scipy.optimize import leastsq
@@ -13,6 +17,10 @@ except:
 
 from .kde import distance
 from .models import Recommender
+from .spatial import SpatialIndex
+from .geo import radians, iter_distances
+from .lru import ScoreCache
+from .executor import Executor, get_state
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +30,38 @@ def approximate_distance(point_i, point_j):
     return k
 
 
+def distance_bins(coords, block_size=256):
+    """Counts of pairwise distances of coords, bin k is the pairs which
+    `approximate_distance` is k / 10.0 km.
+    """
+    counts = np.zeros(0, dtype=np.int64)
+    for start, end, dis in iter_distances(coords, coords, block_size):
+        # pairs (i, j), i < j
+        upper = np.arange(len(coords)) > np.arange(start, end)[:, None]
+        dis = dis[upper & ~np.isnan(dis)]
+        bins = np.floor(dis / 1000.0 * 10 + 0.5).astype(np.int64)
+        counts = _merge(counts, np.bincount(bins))
+    return counts
+
+
+def _merge(x, y):
+    if len(x) < len(y):
+        x, y = y, x
+    x = x.copy()
+    x[: len(y)] += y
+    return x
+
+
+def _proxy_count(users):
+    model, block_size = get_state()
+    coords = model.coords
+    counts = np.zeros(0, dtype=np.int64)
+    for user in users:
+        items = model.checkins.row(user)[0]
+        counts = _merge(counts, distance_bins(coords[items], block_size))
+    return counts
+
+
 class PowerLaw(Recommender):
     """Power Law algorithm.
     usage:
@@ -34,18 +74,29 @@ class PowerLaw(Recommender):
      >>> round(pl.prob(1.0), 2)
      3.53
     """
-    def __init__(self, checkins, locations):
+    def __init__(self, checkins, locations, radius=None, cache_size=1024,
+                 spill=None):
         """Init model.
         checkins: see poi.load_checkins method
         locations: see poi.locations method.
+        radius: km, if assign, only items within radius of some checkin
+                of the user are scored, others predict 0.0.
+        cache_size, spill: probabilities of the cache_size most recently
+                used users are kept, see `poi.lru.ScoreCache`.
         """
         super(PowerLaw, self).__init__(checkins)
         self.locations = locations
+        self.radius = radius
+        self.index = None
+        if radius is not None:
+            self.index = SpatialIndex(locations, self.num_items)
+        self._coords = None
         self.points = []
         self.a = 0.0
         self.b = 0.0
         self.line_ready = False
-        self._cache = {}
+        self._cache = ScoreCache(self.num_items, cache_size, spill=spill,
+                                 num_users=self.num_users)
 
     def __repr__(self):
         return "<PowerLaw [a=%f, b=%f]>" % (self.a, self.b) 
@@ -60,35 +111,97 @@ class PowerLaw(Recommender):
             x = 10 ** (-10)
         return self.a * (x ** self.b)
 
+    @property
+    def coords(self):
+        """radians of items, see `poi.geo.radians`, built once.
+        """
+        if self._coords is None:
+            self._coords = radians(self.locations, self.num_items)
+        return self._coords
+
     def predict(self, user, loc):
         """Predict the probability about user will checkin in loc.
         prob = Pr[l|Li] = IIPr[l, li] (li in Li)
         see: Exploiting Geographical Influence for Collaborative 
              Point-of-Interest Recommendation
         """
-        if user in self._cache:
-            if loc not in self._cache[user]:
-                return 0.0
-            return self._cache[user][loc]
-
-        self._cache[user] = {}
-        max_y = -np.Infinity
-        for l in xrange(self.num_items):
-            if l in self.checkins[user]:
-                continue
-            y = 0.0 
-            for li in self.checkins[user]:
-                d = distance(self.locations[l], self.locations[li]) / 1000.0
-                y += np.log(self.prob(d))
-            if y > max_y:
-                max_y = y
-            self._cache[user][l] = y
-        for l, y in self._cache[user].items():
-            self._cache[user][l] = math.e ** (y - max_y)
-
-        if loc not in self._cache[user]:
-            return 0.0
-        return self._cache[user][loc]
+        return float(self.score_all(user)[loc])
+
+    def score_all(self, user):
+        """Probabilities of user to all items, see `score_batch`.
+        """
+        return self._cache.fetch(user, lambda u: self.score_batch([u])[0])
+
+    def log_sums(self, rows, block_size=256, items=None):
+        """sum(log d) of each csr row of pois to items, d in km, 
+        0.0 is taken as 10 ** -10, like `prob`.
+        Distances of items to the union of pois are computed block by
+        block, a binary csr of rows sums them.
+        items: default all items.
+        return: (num_rows, len(items)) array.
+        """
+        if items is None:
+            items = np.arange(self.num_items)
+        pois = np.unique(rows.indices)
+        indicator = sparse.csr_matrix((np.ones(len(rows.indices)), 
+                                       np.searchsorted(pois, rows.indices),
+                                       rows.indptr), 
+                                      shape=(rows.shape[0], len(pois)))
+        sums = np.zeros((rows.shape[0], len(items)))
+        if len(pois) == 0:
+            return sums
+        coords = self.coords
+        for start, end, dis in iter_distances(coords[items], coords[pois], 
+                                              block_size):
+            dis /= 1000.0
+            dis[dis == 0.0] = 10 ** (-10)
+            sums[:, start: end] = indicator.dot(np.log(dis).T)
+        return sums
+
+    def score_batch(self, users, block_size=256):
+        """Probabilities of users to all items, (len(users), num_items).
+        y = sum(log a + b * log d) of the user's checkins, normalized 
+        as exp(y - max_y) over candidates, checked in items and those
+        out of radius are 0.0. Items without location are 0.0, checkins
+        without location are ignored. Distances are only computed to the
+        items which are a candidate of some user.
+        """
+        users = np.asarray(users, dtype=int)
+        rows = self.checkins.csr[users]
+        located = ~np.isnan(self.coords).any(axis=1)
+        # checkins without location are left out of the product
+        known = rows.copy()
+        known.data = located[known.indices].astype(float)
+        known.eliminate_zeros()
+        num = np.diff(known.indptr)
+        candidate = np.zeros((len(users), self.num_items), dtype=bool)
+        for r, user in enumerate(users):
+            candidate[r, self.candidates(user)] = True
+        visited = np.repeat(np.arange(len(users)), np.diff(rows.indptr))
+        candidate[visited, rows.indices] = False
+        # items without location are never recommended
+        candidate[:, ~located] = False
+        items = np.flatnonzero(candidate.any(axis=0))
+        y = np.zeros(candidate.shape) - np.inf
+        y[:, items] = num[:, None] * np.log(self.a) + \
+            self.b * self.log_sums(known, block_size, items)
+        y[~candidate | np.isnan(y)] = -np.inf
+        max_y = y.max(axis=1)
+        max_y[~np.isfinite(max_y)] = 0.0
+        return np.exp(y - max_y[:, None])
+
+    def candidates(self, user):
+        """Items to score for user, near ones if radius is assigned,
+        checkins without location are skipped, none if nothing is left.
+        """
+        if self.index is None or len(self.checkins[user]) == 0:
+            return xrange(self.num_items)
+        points = self.index.coords[list(self.checkins[user].keys())]
+        points = points[np.isfinite(points).all(axis=1)]
+        if len(points) == 0:
+            return []
+        near = self.index.query_radius(points, self.radius * 1000.0)
+        return np.unique(np.concatenate(near)).tolist()
 
     def guass(self, max_x=None, min_x=0.0):
         """Run Least Square algorithm to guass the line.
@@ -126,34 +239,22 @@ class PowerLaw(Recommender):
 
         self.line_ready = True
 
-    def count(self):
+    def count(self, num_pool=4, block_size=256):
         """Count distance show up how many times in checkins.
+        Pairwise distances of each user's pois are binned by 0.1km, 
+        users are split to num_pool processes, 0 turns it off.
         """
-        data = {}
-        for u in self.checkins:
-            locs = []
-            for l, f in self.checkins[u].items():
-                locs.append(l)
-            num = len(locs)
-            for i in range(num):
-                for j in range(i + 1, num):
-                    pi = self.locations[locs[i]]
-                    pj = self.locations[locs[j]]
-                    k = approximate_distance(pi, pj) 
-                    data[k] = data.get(k, 0) + 1
-        x = []
-        y = []
-        count = 0
-        for k, c in data.items():
-            x.append(k)
-            y.append(float(c))
-            count += c
-        y = [c / count for c in y]
-        arr_x = np.array(x)
-        arr_y = np.array(y)
-        sort_index = np.argsort(arr_x)
-        arr_x = arr_x[sort_index]
-        arr_y = arr_y[sort_index]
+        users = [u for u in self.checkins if self.checkins.degree(u) > 1]
+        chunksize = max(1, len(users) // (max(num_pool, 1) * 8))
+        tasks = [users[i: i + chunksize] 
+                 for i in xrange(0, len(users), chunksize)]
+        counts = np.zeros(0, dtype=np.int64)
+        with Executor(num_pool, state=(self, block_size)) as executor:
+            for part in executor.imap(_proxy_count, tasks, ordered=False):
+                counts = _merge(counts, part)
+        bins = np.flatnonzero(counts)
+        arr_x = bins / 10.0
+        arr_y = counts[bins] / float(counts.sum())
         self.points = [arr_x, arr_y]
 
     def plot(self, filename=None, marker='+', color='blue'):
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""Negative samplers for pairwise ranking models.
+    A sampler draws (user, pos, neg) triples in batches: user is 
+    uniform over users who have checkins, pos is uniform over the 
+    user's checkins, neg is an item the user never checked in.
+    Samplers differ in how negatives are drawn:
+        uniform   : uniform over all items.
+        popularity: proportional to item popularity, by an alias table.
+        geo       : near items of the positive one, mixed with uniform.
+        dynamic   : highest scored of several uniform candidates.
+    Each draw is O(1), rejected negatives are drawn again.
+"""
+
+import logging
+
+import numpy as np
+
+from .utils import csr_keys, in_keys
+from .spatial import SpatialIndex
+
+__all__ = ["UniformSampler", "PopularitySampler", "GeoSampler", 
+           "DynamicSampler", "make_sampler", "alias_table"]
+
+log = logging.getLogger(__name__)
+
+
+def alias_table(weights):
+    """Walker's alias table for O(1) sampling from discrete distribution.
+    return: (prob, alias), draw i uniformly, keep it with prob[i],
+            else take alias[i].
+    usage:
+     >>> prob, alias = alias_table([1.0, 3.0])
+     >>> print prob, alias
+     [ 0.5  1. ] [1 1]
+    """
+    weights = np.asarray(weights, dtype=float)
+    num = len(weights)
+    prob = weights * num / weights.sum()
+    alias = np.arange(num)
+    small = [i for i in xrange(num) if prob[i] < 1.0]
+    large = [i for i in xrange(num) if prob[i] >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] -= 1.0 - prob[s]
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # numerical leftovers
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+class UniformSampler(object):
+    """Uniform negative sampler backed by csr arrays.
+    matrix: (num_users, num_items) csr checkin matrix.
+    seed  : seed of the numpy random generator.
+    usage:
+     >>> from scipy.sparse import csr_matrix
+     >>> m = csr_matrix([[1, 0, 1], [0, 0, 0], [0, 1, 0]])
+     >>> users, pos, neg = UniformSampler(m, seed=1).sample(100)
+     >>> print sorted(set(users)), m[users, pos].min(), m[users, neg].max()
+     [0, 2] 1 0
+    """
+    def __init__(self, matrix, seed=None):
+        matrix = matrix.tocsr()
+        matrix.sort_indices()
+        self.num_users, self.num_items = matrix.shape
+        self.indptr = matrix.indptr
+        self.indices = matrix.indices
+        self.degrees = np.diff(matrix.indptr)
+        self.keys = csr_keys(matrix)
+        # users who have both positive and negative items
+        self.users = np.nonzero((self.degrees > 0) & 
+                                (self.degrees < self.num_items))[0]
+        if len(self.users) == 0:
+            raise ValueError("no user can be sampled.")
+        self.random = np.random.RandomState(seed)
+
+    def seed(self, seed=None):
+        self.random = np.random.RandomState(seed)
+
+    def contains(self, users, items):
+        """Whether each user checked in the corresponding item.
+        """
+        return in_keys(self.keys, users, items, self.num_items)
+
+    def sample_users(self, size):
+        return self.users[self.random.randint(len(self.users), size=size)]
+
+    def sample_positives(self, users):
+        offset = self.random.random_sample(len(users)) * self.degrees[users]
+        return self.indices[self.indptr[users] + offset.astype(int)]
+
+    def draw_negatives(self, users, pos):
+        """Candidate negatives, which may be checked in by users.
+        """
+        return self.random.randint(self.num_items, size=len(users))
+
+    def sample_negatives(self, users, pos):
+        """Items not checked in by users, rejection sampling.
+        """
+        neg = self.draw_negatives(users, pos)
+        reject = np.nonzero(self.contains(users, neg))[0]
+        while len(reject) > 0:
+            neg[reject] = self.draw_negatives(users[reject], pos[reject])
+            reject = reject[self.contains(users[reject], neg[reject])]
+        return neg
+
+    def sample(self, size):
+        """Draw size triples.
+        return: (users, pos, neg), three int arrays.
+        """
+        users = self.sample_users(size)
+        pos = self.sample_positives(users)
+        neg = self.sample_negatives(users, pos)
+        return users, pos, neg
+
+
+class PopularitySampler(UniformSampler):
+    """Negatives proportional to (checkins of item + 1) ** power.
+    """
+    def __init__(self, matrix, seed=None, power=0.75):
+        super(PopularitySampler, self).__init__(matrix, seed)
+        counts = np.bincount(self.indices, minlength=self.num_items)
+        self.prob, self.alias = alias_table((counts + 1.0) ** power)
+
+    def draw_negatives(self, users, pos):
+        index = self.random.randint(self.num_items, size=len(users))
+        keep = self.random.random_sample(len(users)) < self.prob[index]
+        return np.where(keep, index, self.alias[index])
+
+
+class GeoSampler(UniformSampler):
+    """Negatives near the positive item. 
+    With probability ratio, negative is one of the num_near nearest
+    items of the positive item, else uniform.
+    locations: {item: (lat, lon), ...}, see `load_locations`.
+    """
+    def __init__(self, matrix, locations, seed=None, num_near=50, 
+                 ratio=0.5):
+        super(GeoSampler, self).__init__(matrix, seed)
+        if not 0.0 <= ratio < 1.0:
+            raise ValueError("ratio should in [0.0, 1.0).")
+        self.ratio = ratio
+        self.num_near = min(num_near, self.num_items - 1)
+        self.near = self._nearest(SpatialIndex(locations, self.num_items))
+
+    def _nearest(self, index):
+        """(num_items, num_near) nearest items of each item, by a 
+        `SpatialIndex`, items without location get uniform ones.
+        """
+        near = self.random.randint(self.num_items, 
+                                   size=(self.num_items, self.num_near))
+        items = index.items
+        if len(items) <= self.num_near:
+            return near.astype(np.int32)
+        dis, found = index.query_items(items, self.num_near + 1)
+        # drop the item itself, or the farthest if same place items 
+        # push it out
+        columns = np.argsort(found == items[:, None], axis=1, kind="mergesort")
+        rows = np.arange(len(items))[:, None]
+        near[items] = found[rows, columns[:, : self.num_near]]
+        return near.astype(np.int32)
+
+    def draw_negatives(self, users, pos):
+        neg = self.random.randint(self.num_items, size=len(users))
+        geo = np.nonzero(self.random.random_sample(len(users)) < self.ratio)[0]
+        column = self.random.randint(self.num_near, size=len(geo))
+        neg[geo] = self.near[pos[geo], column]
+        return neg
+
+
+class DynamicSampler(UniformSampler):
+    """Rank aware negatives: draw num_candidates uniform negatives, keep
+    the one model scores highest, see "Improving pairwise learning for 
+    item recommendation from implicit feedback".
+    model: factor model, which has user_vectors and item_vectors.
+    """
+    def __init__(self, matrix, model, seed=None, num_candidates=5):
+        super(DynamicSampler, self).__init__(matrix, seed)
+        self.model = model
+        self.num_candidates = num_candidates
+
+    def sample_negatives(self, users, pos):
+        num = self.num_candidates
+        rep_users = np.repeat(users, num)
+        candidates = super(DynamicSampler, self).sample_negatives(
+            rep_users, np.repeat(pos, num)).reshape(len(users), num)
+        uvec = self.model.user_vectors[users]
+        # column by column, never a (len(users), num, factors) array
+        scores = np.zeros((len(users), num))
+        for c in xrange(num):
+            ivec = self.model.item_vectors[candidates[:, c]]
+            scores[:, c] = (ivec * uvec).sum(axis=1)
+        best = scores.argmax(axis=1)
+        return candidates[np.arange(len(users)), best]
+
+
+SAMPLERS = {
+    "uniform": UniformSampler,
+    "popularity": PopularitySampler,
+    "geo": GeoSampler,
+    "dynamic": DynamicSampler,
+}
+
+
+def make_sampler(name, matrix, seed=None, model=None, locations=None, 
+                 **kwargs):
+    """Create a sampler by name, see `SAMPLERS`.
+    model    : required by dynamic sampler.
+    locations: required by geo sampler.
+    kwargs   : other arguments of the sampler.
+    """
+    if name not in SAMPLERS:
+        raise ValueError("sampler should be one of %s." % sorted(SAMPLERS))
+    if name == "geo":
+        if locations is None:
+            raise ValueError("geo sampler need locations.")
+        return GeoSampler(matrix, locations, seed=seed, **kwargs)
+    if name == "dynamic":
+        if model is None:
+            raise ValueError("dynamic sampler need model.")
+        return DynamicSampler(matrix, model, seed=seed, **kwargs)
+    return SAMPLERS[name](matrix, seed=seed, **kwargs)
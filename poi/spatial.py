@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""Spatial index of POI locations.
+    Locations are put on the unit sphere, a KD-tree over the 3d points
+    answers radius and k nearest queries in bulk. Straight line (chord)
+    distance on the sphere grows with the great circle distance, so
+    results are exact, distances are converted back to meter, same as
+    `poi.kde.distance`.
+    usage:
+     >>> locs = {0: (0.0, 0.0), 1: (0.0, 0.001), 2: (0.0, 1.0)}
+     >>> index = SpatialIndex(locs)
+     >>> dis, items = index.query_items([0], 2)
+     >>> print items, dis.round(2)
+     [[0 1]] [[   0.    111.32]]
+     >>> print index.query_radius(index.coords[[0]], 1000.0)
+     [array([0, 1])]
+"""
+
+import logging
+
+import numpy as np
+try:
+    import scipy.sparse as sparse
+    from scipy.spatial import cKDTree
+except:
+    pass
+
+from .geo import EARTH_RADIUS, radians, haversine
+
+__all__ = ["SpatialIndex", "to_chord", "to_meter"]
+
+log = logging.getLogger(__name__)
+
+
+def to_chord(meters):
+    """Great circle distance in meter to chord length on unit sphere.
+    """
+    theta = np.minimum(np.asarray(meters, dtype=float) / EARTH_RADIUS, np.pi)
+    return 2.0 * np.sin(theta * 0.5)
+
+
+def to_meter(chords):
+    """Chord length on unit sphere to great circle distance in meter.
+    """
+    chords = np.minimum(np.asarray(chords, dtype=float), 2.0)
+    return 2.0 * np.arcsin(chords * 0.5) * EARTH_RADIUS
+
+
+def _xyz(coords):
+    lat, lon = coords[:, 0], coords[:, 1]
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+class SpatialIndex(object):
+    """KD-tree over item locations.
+    locations: {item: (lat, lon), ...}, see `load_locations`, or a
+               radians array, see `poi.geo.radians`.
+    num_items: items without location are never returned.
+    Points of queries are (n, 2) radians arrays.
+    """
+    def __init__(self, locations, num_items=None, leafsize=16):
+        if isinstance(locations, dict):
+            self.coords = radians(locations, num_items)
+        else:
+            self.coords = np.asarray(locations, dtype=float)[: num_items]
+        self.num_items = len(self.coords)
+        valid = ~np.isnan(self.coords).any(axis=1)
+        # tree index to item
+        self.items = np.flatnonzero(valid)
+        self.tree = cKDTree(_xyz(self.coords[self.items]), leafsize=leafsize)
+
+    def __repr__(self):
+        return "<SpatialIndex [items=%i]>" % len(self.items)
+
+    def query(self, points, k=1):
+        """k nearest items of each point.
+        return: (distances, items), (len(points), k) arrays, item -1 and
+                distance inf if there are less than k items.
+        """
+        k = max(1, int(k))
+        chords, index = self.tree.query(_xyz(np.asarray(points)), k=k)
+        chords = np.asarray(chords, dtype=float).reshape(len(points), k)
+        index = np.asarray(index).reshape(len(points), k)
+        found = index < len(self.items)
+        items = np.zeros(index.shape, dtype=np.int32) - 1
+        items[found] = self.items[index[found]]
+        dis = np.zeros(index.shape) + np.inf
+        dis[found] = to_meter(chords[found])
+        return dis, items
+
+    def query_items(self, items, k=1):
+        """k nearest items of each item, the item itself included.
+        """
+        return self.query(self.coords[np.asarray(items, dtype=int)], k)
+
+    def query_radius(self, points, radius):
+        """Items within radius meters of each point.
+        return: list of sorted item arrays.
+        """
+        lists = self.tree.query_ball_point(_xyz(np.asarray(points)),
+                                           to_chord(radius))
+        return [np.sort(self.items[np.asarray(l, dtype=int)]) for l in lists]
+
+    def within(self, points, radius):
+        """Distances of items within radius meters of each point.
+        return: (len(points), num_items) csr matrix of distances in meter,
+                an item at distance 0.0 is stored explicitly.
+        """
+        points = np.asarray(points)
+        lists = self.query_radius(points, radius)
+        sizes = np.array([len(l) for l in lists], dtype=np.int64)
+        indptr = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        indices = np.concatenate(lists + [np.zeros(0, dtype=int)])
+        rows = np.repeat(np.arange(len(points)), sizes)
+        data = haversine(points[rows, 0], points[rows, 1],
+                         self.coords[indices, 0], self.coords[indices, 1])
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(len(points), self.num_items))
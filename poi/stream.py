@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming checkin ingestion for datasets larger than memory.
+    build_csr:
+        1. read files chunk by chunk, append (user, item, freq) records
+           to on disk partitions hashed by user.
+        2. aggregate each partition alone, repeated (user, item) sum
+           together, count items of each user.
+        3. scatter partitions into memory mapped csr arrays.
+    open_csr: open the result as a `CheckinMatrix` without loading it.
+    usage:
+    >>> import tempfile, StringIO
+    >>> s = StringIO.StringIO("0 1\\n2 2\\n0 1\\n0 0\\n")
+    >>> cks = build_csr([s], tempfile.mkdtemp(), chunk_lines=2)
+    >>> print cks[0].items(), cks[2].items()
+    [(0, 1.0), (1, 2.0)] [(2, 1.0)]
+"""
+
+import os
+import glob
+import json
+import time
+import logging
+from itertools import islice
+
+import numpy as np
+try:
+    import scipy.sparse as sparse
+except:
+    pass
+
+from .loader import parse_table
+from .checkins import CheckinMatrix
+
+__all__ = ["iter_chunks", "build_csr", "open_csr"]
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def iter_chunks(infile, index=None, chunk_lines=1000000):
+    """Yield (users, items, freqs) arrays of every chunk_lines lines.
+    infile: file name or file object.
+    index : columns of (uid, iid) or (uid, iid, freq), see `load_table`.
+    """
+    if index is None:
+        index = (0, 1)
+    if not hasattr(infile, "read"):
+        with open(infile) as fp:
+            for chunk in iter_chunks(fp, index, chunk_lines):
+                yield chunk
+        return
+    while True:
+        lines = list(islice(infile, chunk_lines))
+        if len(lines) == 0:
+            break
+        table = parse_table("".join(lines))
+        if len(table) == 0:
+            continue
+        users = table[:, index[0]].astype(np.int64)
+        items = table[:, index[1]].astype(np.int64)
+        if len(index) >= 3:
+            freqs = table[:, index[2]]
+        else:
+            freqs = np.ones(len(table))
+        yield users, items, freqs
+
+
+def _partition(directory, p):
+    return os.path.join(directory, "part-%04i.bin" % p)
+
+
+def _read_partition(directory, p):
+    path = _partition(directory, p)
+    if not os.path.exists(path):
+        return np.zeros((0, 3))
+    return np.fromfile(path, dtype=np.float64).reshape(-1, 3)
+
+
+def build_csr(files, directory, index=None, num_partitions=64,
+              chunk_lines=1000000):
+    """Build a memory mapped csr checkin matrix from files.
+    files    : list of file names or file objects.
+    directory: output directory, also holds the temporary partitions,
+               stale partitions in it are removed first.
+    num_partitions: a partition should fit in memory.
+    return: `CheckinMatrix`, see `open_csr`.
+    """
+    t0 = time.time()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # partitions are appended to, drop the ones left by an aborted run
+    for path in glob.glob(os.path.join(directory, "part-*.bin")):
+        os.remove(path)
+    num_users = 0
+    num_items = 0
+    count = 0
+    # 1. hash records to partitions by user
+    for infile in files:
+        for users, items, freqs in iter_chunks(infile, index, chunk_lines):
+            count += len(users)
+            num_users = max(num_users, int(users.max()) + 1)
+            num_items = max(num_items, int(items.max()) + 1)
+            part = users % num_partitions
+            order = np.argsort(part, kind="mergesort")
+            records = np.column_stack((users, items, freqs))[order]
+            bounds = np.searchsorted(part[order], np.arange(num_partitions + 1))
+            for p in xrange(num_partitions):
+                if bounds[p] == bounds[p + 1]:
+                    continue
+                with open(_partition(directory, p), "ab") as fp:
+                    records[bounds[p]: bounds[p + 1]].tofile(fp)
+            log.debug("read %i records, time %.2fs" % (count, time.time() - t0))
+
+    # 2. aggregate partitions, count degree of users
+    degrees = np.zeros(num_users, dtype=np.int64)
+    for p in xrange(num_partitions):
+        records = _read_partition(directory, p)
+        if len(records) == 0:
+            continue
+        keys = records[:, 0].astype(np.int64) * num_items + \
+            records[:, 1].astype(np.int64)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        freqs = np.bincount(inverse, weights=records[:, 2])
+        users = unique // num_items
+        records = np.column_stack((users, unique % num_items, freqs))
+        records.tofile(_partition(directory, p))
+        degrees += np.bincount(users, minlength=num_users)
+
+    # 3. scatter to csr arrays
+    indptr = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    nnz = int(indptr[-1])
+    np.save(os.path.join(directory, "indptr.npy"), indptr)
+    open_memmap = np.lib.format.open_memmap
+    indices = open_memmap(os.path.join(directory, "indices.npy"), mode="w+",
+                          dtype=np.int32, shape=(nnz, ))
+    data = open_memmap(os.path.join(directory, "data.npy"), mode="w+",
+                       dtype=np.float32, shape=(nnz, ))
+    for p in xrange(num_partitions):
+        records = _read_partition(directory, p)
+        if os.path.exists(_partition(directory, p)):
+            os.remove(_partition(directory, p))
+        if len(records) == 0:
+            continue
+        # records are sorted by (user, item)
+        users = records[:, 0].astype(np.int64)
+        first = np.searchsorted(users, users)
+        pos = indptr[users] + np.arange(len(users)) - first
+        indices[pos] = records[:, 1]
+        data[pos] = records[:, 2]
+    indices.flush()
+    data.flush()
+    del indices, data
+
+    meta = {"version": FORMAT_VERSION, "shape": [num_users, num_items],
+            "nnz": nnz, "records": count}
+    with open(os.path.join(directory, "meta.json"), "w") as fp:
+        json.dump(meta, fp)
+    t1 = time.time()
+    log.debug("build csr %i records, %i users, %i pois, %i nnz, time %.2fs" %
+              (count, num_users, num_items, nnz, t1 - t0))
+    return open_csr(directory)
+
+
+def open_csr(directory):
+    """Open csr arrays written by `build_csr` as memory map.
+    return: `CheckinMatrix`.
+    """
+    with open(os.path.join(directory, "meta.json")) as fp:
+        meta = json.load(fp)
+    if meta["version"] != FORMAT_VERSION:
+        raise ValueError("unknown format version: %s." % meta["version"])
+    arrays = [np.load(os.path.join(directory, "%s.npy" % name), mmap_mode="r")
+              for name in ("data", "indices", "indptr")]
+    csr = sparse.csr_matrix(tuple(arrays), shape=tuple(meta["shape"]),
+                            copy=False)
+    return CheckinMatrix(csr)
@@ -4,7 +4,12 @@ import logging
 import math
 
 import numpy as np
+try:
+    import scipy.sparse as sparse
+except:
+    pass
 from .models import Recommender 
+from .utils import topn_rows
 
 __all__ = ["UserBase"]
 
@@ -116,22 +121,43 @@ class UserBase(Recommender):
         super(UserBase, self).__init__(checkins);
         self.num_neighbors = num_neighbors
         self._neighbors = None 
-        self.between = SSMatrix(self.num_items) 
+        self.between = SSMatrix(self.num_users) 
 
     def __repr__(self):
         return "<UserBase [K=%i]>" % self.num_neighbors
 
-    def similarity(self):
+    def similarity(self, top_k=None, block_size=256):
+        """Cos similarity of users, same as `similarity`, by row blocks 
+        of X * X^T, X is the l2 normalized checkin matrix.
+        top_k: only the top_k most similar users of each user are kept,
+               default num_neighbors, 0 keeps all, `neighbors` of at
+               most top_k are exact.
+        """
         t0 = time.time()
-        for ui in xrange(self.num_users):
-            for uj in xrange(ui + 1, self.num_users):
-                s = similarity(self.checkins[ui], self.checkins[uj])
-                self.between[ui, uj] = s
-
-            if ui % 200 == 0:
-                t1 = time.time()
-                log.debug("similarity user: %i(%.f%%) time: %.2fs" % \
-                        (ui, ui * 100.0 / self.num_users, t1 - t0))
+        if top_k is None:
+            top_k = self.num_neighbors
+        if top_k <= 0:
+            top_k = self.num_users
+        top_k = min(top_k, self.num_users - 1)
+        matrix = sparse.csr_matrix(self.checkins.csr, dtype=np.float64)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)))
+        norms[norms == 0.0] = 1.0
+        matrix = sparse.csr_matrix(matrix.multiply(1.0 / norms))
+        trans = matrix.T.tocsr()
+
+        for start in xrange(0, self.num_users, block_size):
+            end = min(start + block_size, self.num_users)
+            sims = matrix[start: end].dot(trans).toarray()
+            sims[np.arange(end - start), np.arange(start, end)] = 0.0
+            sims[sims <= 0.0] = -np.inf
+            index = topn_rows(sims, top_k)
+            for r, row in enumerate(index):
+                for u in row[row >= 0].tolist():
+                    self.between[start + r, u] = float(sims[r, u])
+
+            t1 = time.time()
+            log.debug("similarity user: %i(%.f%%) time: %.2fs" % \
+                    (end, end * 100.0 / self.num_users, t1 - t0))
 
     def neighbors(self, num_neighbors=None):
         t1  = time.time()
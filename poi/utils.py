@@ -2,7 +2,8 @@
 
 import logging
 import random
-from multiprocessing import Pool 
+import ctypes
+from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 try:
@@ -10,6 +11,9 @@ try:
 except:
     pass
 
+from .executor import Executor
+from .checkins import CheckinMatrix
+
 log = logging.getLogger(__name__)
 
 def nonzero(matrix, row):
@@ -43,18 +47,122 @@ def randint(low, height=None):
         return random.randint(0, low - 1)
 
 
-def threads(func, params, num=4, output=True):
-    pool = Pool(num)
-    if output:
-        results = pool.map(func, params) 
+def _nan_to_neginf(scores):
+    # nan would rank below the -inf of ruled out items
+    if scores.dtype.kind == "f" and np.isnan(scores).any():
+        return np.where(np.isnan(scores), -np.inf, scores)
+    return scores
+
+
+def topn(scores, num):
+    """Return index of the `num` largest scores, best first,
+    ties are broken by index like a stable sort, nan ranks as -inf.
+    scores: one dim array like.
+    usage:
+     >>> print topn(np.array([0.1, 0.5, 0.3, 0.5]), 3)
+     [1 3 2]
+    """
+    scores = _nan_to_neginf(np.asarray(scores))
+    num = min(num, len(scores))
+    if num <= 0:
+        return np.array([], dtype=int)
+    if num < len(scores):
+        index = np.argpartition(-scores, num - 1)[: num]
+        # argpartition keeps any of the ties of the num-th score
+        index = np.flatnonzero(scores >= scores[index].min())
     else:
-        pool.map(func, params) 
-    pool.close()
-    pool.join()
+        index = np.arange(len(scores))
+    order = np.lexsort((index, -scores[index]))
+    return index[order][: num]
+
+
+def topn_rows(scores, num):
+    """Row wise `topn` for a two dim scores matrix.
+    Return (rows, num) int32 array, position of -inf or nan score is -1.
+    usage:
+     >>> s = np.array([[0.1, 0.5, 0.3], [0.2, -np.inf, -np.inf]])
+     >>> print topn_rows(s, 2)
+     [[ 1  2]
+      [ 0 -1]]
+    """
+    scores = _nan_to_neginf(np.asarray(scores))
+    num_rows, num_cols = scores.shape
+    num = min(num, num_cols)
+    if num <= 0:
+        return np.zeros((num_rows, 0), dtype=np.int32)
+    if num < num_cols:
+        index = np.argpartition(-scores, num - 1, axis=1)[:, : num]
+    else:
+        index = np.tile(np.arange(num_cols), (num_rows, 1))
+    rows = np.arange(num_rows)[:, None]
+    if num < num_cols:
+        # rows with more ties of the num-th score than kept are redone
+        kth = scores[rows, index].min(axis=1)
+        tied = np.flatnonzero((scores >= kth[:, None]).sum(axis=1) > num)
+        for r in tied:
+            index[r] = topn(scores[r], num)
+    values = scores[rows, index]
+    order = np.lexsort((index, -values), axis=1)
+    index = index[rows, order].astype(np.int32)
+    index[np.isneginf(values[rows, order])] = -1
+    return index
+
+
+def csr_keys(matrix):
+    """Sorted int64 keys `row * num_cols + col` of nonzero entries of a 
+    csr matrix, for vectorized membership test by `in_keys`.
+    """
+    matrix = matrix.tocsr()
+    matrix.sort_indices()
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), 
+                     np.diff(matrix.indptr))
+    return rows * matrix.shape[1] + matrix.indices
+
+
+def in_keys(keys, rows, cols, num_cols):
+    """Whether each (rows[i], cols[i]) is in keys, see `csr_keys`.
+    usage:
+     >>> from scipy.sparse import csr_matrix
+     >>> keys = csr_keys(csr_matrix([[1, 0, 2], [3, 0, 0]]))
+     >>> print in_keys(keys, np.array([0, 0, 1]), np.array([2, 1, 0]), 3)
+     [ True False  True]
+    """
+    query = np.asarray(rows, dtype=np.int64) * num_cols + cols
+    if len(keys) == 0:
+        return np.zeros(len(query), dtype=bool)
+    index = np.searchsorted(keys, query)
+    index[index >= len(keys)] = 0
+    return keys[index] == query
+
+
+def threads(func, params, num=4, output=True):
+    """Map func over params by a one-off process pool, each param is 
+    pickled to workers, for large shared state use `Executor`.
+    """
+    with Executor(num) as executor:
+        results = executor.map(func, params)
     if output:
         return results
 
 
+def shared_array(shape, dtype=float, data=None):
+    """Numpy array on shared memory, processes forked after its creation
+    read and write the same memory, nothing will be pickled.
+    data: if assigned, copy data to the array.
+    usage:
+     >>> a = shared_array((2, 3), data=np.ones((2, 3)))
+     >>> print a.sum()
+     6.0
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = RawArray(ctypes.c_char, max(size * dtype.itemsize, 1))
+    array = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+    if data is not None:
+        array[...] = data
+    return array
+
+
 def linspace(low, height, num=4): 
     """[low, height)
     usage:
@@ -76,10 +184,13 @@ def linspace(low, height, num=4):
     
 
 
-def tomatrix(checkins):
+def tomatrix(checkins, shape=None):
     """Make checkins to a `sparse matrix` object.
     checkins: {uid: [(iid, freq), ...], ...} or {uid: [uid, ...], ...},
              see `load_checkins` for detail.
+             or a `CheckinMatrix`, whose csr matrix is returned if shape
+             is the same.
+    shape: (num_users, num_items), default is decided by max user and item.
     usage:
      >>> import StringIO
      >>> s = StringIO.StringIO("0 1 2\\n0 2 3\\n2 2 4\\n")
@@ -90,6 +201,12 @@ def tomatrix(checkins):
        (0, 2) 3
        (2, 2) 4
     """
+    if isinstance(checkins, CheckinMatrix):
+        if shape is None or tuple(shape) == checkins.shape:
+            return checkins.csr
+        coo = checkins.csr.tocoo()
+        return sparse.csr_matrix((coo.data, (coo.row, coo.col)), shape=shape)
+
     row = []
     col = []
     data = []
@@ -114,7 +231,9 @@ def tomatrix(checkins):
         
         users.add(user)
 
-    matrix = sparse.csr_matrix((data, (row, col)), shape=(max(users) + 1, max(items) + 1))
+    if shape is None:
+        shape = (max(users) + 1, max(items) + 1)
+    matrix = sparse.csr_matrix((data, (row, col)), shape=shape)
     return matrix
 
 
@@ -5,25 +5,34 @@ import logging
 
 try:
     import scipy.sparse as sparse
-    from scipy.sparse.linalg import spsolve
 except:
     pass
 
 from .models import Recommender 
-from .utils import tomatrix
+from .als import least_squares, ParallelALS
 
 __all__ = ["WMF"]
 
 log = logging.getLogger(__name__)
 
 class WMF(Recommender):
+    """Weighted Matrix Factorization, solved by implicit ALS.
+    solver  : "cholesky" solve exactly, "cg" run cg_steps conjugate 
+              gradient steps from current vectors, much faster.
+    cg_steps: see solver.
+    n_jobs  : number of processes to solve rows, 1 turn off multiple 
+              processes. Factors are kept in shared memory while training.
+    """
     def __init__(self, checkins, num_factors=10, num_iterations=30,
-                 reg_param=0.1):
+                 reg_param=0.1, solver="cholesky", cg_steps=3, n_jobs=1):
         super(WMF, self).__init__(checkins);
-        self.matrix = tomatrix(checkins)
+        self.matrix = self.checkins.csr
         self.num_factors = num_factors
         self.num_iterations = num_iterations
         self.reg_param = reg_param
+        self.solver = solver
+        self.cg_steps = cg_steps
+        self.n_jobs = n_jobs
         self.current = 0 
         # init factor
         self.user_vectors = np.random.normal(size=(self.num_users,
@@ -35,16 +44,40 @@ class WMF(Recommender):
         return "<WMF [factors=%i, reg=%.4f]>" % (self.num_factors, self.reg_param)
 
     def train(self, before=None, after=None):
+        parallel = None
+        if self.n_jobs > 1:
+            parallel = ParallelALS(self.matrix, self.user_vectors, 
+                                   self.item_vectors, self.reg_param, 
+                                   self.solver, self.cg_steps, self.n_jobs)
+            # hooks see the vectors being solved
+            self.user_vectors = parallel.user_vectors
+            self.item_vectors = parallel.item_vectors
+        try:
+            self._train(parallel, before, after)
+        finally:
+            if parallel is not None:
+                parallel.close()
+                self.user_vectors = np.array(self.user_vectors)
+                self.item_vectors = np.array(self.item_vectors)
+
+    def _train(self, parallel, before, after):
         while self.current < self.num_iterations:
             self.current += 1 
             t0 = time.time()
             # call back before hook
             if before is not None:
                 before(self)
-            #print 'Solving for user vectors...'
-            self.user_vectors = self.iteration(True, sparse.csr_matrix(self.item_vectors))
-            #print 'Solving for item vectors...'
-            self.item_vectors = self.iteration(False, sparse.csr_matrix(self.user_vectors))
+            if parallel is not None:
+                parallel.solve(True)
+            else:
+                self.user_vectors = self.iteration(True, self.item_vectors)
+            t2 = time.time()
+            if parallel is not None:
+                parallel.solve(False)
+            else:
+                self.item_vectors = self.iteration(False, self.user_vectors)
+            t3 = time.time()
+            log.debug('solve users %.2fs, items %.2fs' % (t2 - t0, t3 - t2))
 
             # call back the after hook
             if after is not None:
@@ -56,26 +89,24 @@ class WMF(Recommender):
     def predict(self, user, item):
         return self.user_vectors[user].T.dot(self.item_vectors[item])
 
-    def iteration(self, user, fixed_vecs):
-        num_solve = self.num_users if user else self.num_items
-        num_fixed = fixed_vecs.shape[0]
-        YTY = fixed_vecs.T.dot(fixed_vecs)
-        eye = sparse.eye(num_fixed)
-        lambda_eye = self.reg_param * sparse.eye(self.num_factors)
-        solve_vecs = np.zeros((num_solve, self.num_factors))
+    def score_all(self, user):
+        return self.item_vectors.dot(self.user_vectors[user])
 
-        for i in xrange(num_solve):
-            if user:
-                matrix_i = self.matrix[i].toarray()
-            else:
-                matrix_i = self.matrix[:, i].T.toarray()
-            CuI = sparse.diags(matrix_i, [0])
-            pu = matrix_i.copy()
-            pu[np.where(pu != 0)] = 1.0
-            YTCuIY = fixed_vecs.T.dot(CuI).dot(fixed_vecs)
-            YTCupu = fixed_vecs.T.dot(CuI + eye).dot(sparse.csr_matrix(pu).T)
-            xu = spsolve(YTY + YTCuIY + lambda_eye, YTCupu)
-            solve_vecs[i] = xu
+    def score_batch(self, users):
+        return self.user_vectors[np.asarray(users)].dot(self.item_vectors.T)
 
-        return solve_vecs
-        
+    def iteration(self, user, fixed_vecs):
+        """Solve user vectors if user is True, else item vectors.
+        """
+        if sparse.issparse(fixed_vecs):
+            fixed_vecs = fixed_vecs.toarray()
+        if user:
+            matrix = self.matrix
+            init = self.user_vectors
+        else:
+            # transpose of csc is the item csr matrix
+            matrix = self.checkins.csc.T
+            init = self.item_vectors
+        return least_squares(matrix, fixed_vecs, self.reg_param, 
+                             solver=self.solver, init=init, 
+                             cg_steps=self.cg_steps)
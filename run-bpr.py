@@ -8,8 +8,8 @@ if __name__ == "__main__":
     mdname = "bpr"
     fn = Filename("foursquare")
     setup_log(fn.log(mdname))
-    train_cks = poi.load_checkins(open(fn.train))
-    test_cks = poi.load_checkins(open(fn.test))
+    train_cks = poi.bulk_load_checkins(fn.train)
+    test_cks = poi.bulk_load_checkins(fn.test)
 
     eva = poi.Evaluation(test_cks, full=False)
     def hook(model):
@@ -4,6 +4,8 @@ import time
 import cPickle
 import logging
 
+import poi
+
 log = logging.getLogger(__name__)
 
 class Filename(object):
@@ -33,16 +35,9 @@ def read_model(filename):
 
 
 def poi_locations(filename):
-    locations = {}
-    with open(filename) as in_file:
-        for line in in_file:
-            params = line.strip().split('\t')
-            item = int(params[1])
-            lat, lon = params[2].split(",")
-            lat = float(lat)
-            lon = float(lon)
-            locations[item] = (lat, lon)
-    return locations
+    """Locations from checkin file, "uid\tiid\tlat,lon\t...".
+    """
+    return poi.bulk_load_locations(filename, index=(1, 2, 3))
 
 
 def setup_log(filename=None):